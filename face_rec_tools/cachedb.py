@@ -1,100 +1,403 @@
 #!/usr/bin/python3
 
 import os
+import re
 import sys
+import time
+import queue
 import atexit
 import sqlite3
 import argparse
 import threading
+import contextlib
+import collections
+import urllib.request
 
 sys.path.insert(0, os.path.abspath('..'))
 
 from face_rec_tools import log  # noqa
 
 SCHEMA = '''
+PRAGMA auto_vacuum=INCREMENTAL;
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+
 CREATE TABLE IF NOT EXISTS face_images (
     "face_id" INTEGER PRIMARY KEY NOT NULL,
-    "data" BLOB
+    "data" BLOB,
+    "atime" INTEGER DEFAULT 0
 );
 
 CREATE TABLE IF NOT EXISTS cache (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
     "filename" TEXT,
-    "face_id" INTEGER
+    "face_id" INTEGER,
+    "name" TEXT,
+    "sort_key" TEXT
 );
 
 CREATE UNIQUE INDEX IF NOT EXISTS cache_filename ON cache (filename);
+CREATE INDEX IF NOT EXISTS cache_name_filename ON cache (name, filename);
+CREATE INDEX IF NOT EXISTS cache_name_sort_key ON cache (name, sort_key);
+
+CREATE TABLE IF NOT EXISTS info (
+    "key" TEXT PRIMARY KEY NOT NULL,
+    "value" INTEGER
+);
+'''
+
+GET_FROM_CACHE_QUERY = '''
+SELECT data, face_images.face_id FROM face_images
+JOIN cache ON face_images.face_id=cache.face_id
+WHERE filename=?
+'''
+
+# face images are immutable, already saved face is kept
+INSERT_FACE_QUERY = '''
+INSERT OR IGNORE INTO face_images (face_id, data, atime)
+VALUES (?, ?, strftime('%s', 'now'))
+'''
+
+# existing row keeps its id, so it is not listed as added again
+INSERT_CACHE_QUERY = '''
+INSERT INTO cache (filename, face_id, name, sort_key)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (filename) DO UPDATE SET face_id=excluded.face_id
 '''
 
+TOUCH_FACE_QUERY = '''
+UPDATE face_images SET atime=strftime('%s', 'now') WHERE face_id=?
+'''
+
+# sqlite default SQLITE_MAX_VARIABLE_NUMBER
+MAX_QUERY_PARAMS = 999
+
+
+def cache_name(filename):
+    splitted = filename.split(os.path.sep)
+    return splitted[-2] if len(splitted) > 1 else ''
+
+
+def cache_sort_key(filename):
+    # face file name without distance: sorted by source file name (date)
+    return re.sub(r'_\d\d\d_', '_', os.path.basename(filename))
+
+
+def cache_row(filename, face_id):
+    return (filename, face_id, cache_name(filename), cache_sort_key(filename))
+
 
 class CacheDB(object):
-    def __init__(self, filename):
+    def __init__(self, filename, buffer_size=256, flush_interval=5,
+                 commit_interval=0, readers=0, max_size=0):
+        self.__filename = filename
+        self.__max_size = int(max_size) * 1024 * 1024
         self.__conn = sqlite3.connect(
             filename,
             check_same_thread=False)
 
+        self.__migrate()
         self.__conn.executescript(SCHEMA)
         self.__lock = threading.RLock()
+
+        # read-only connections see only committed data,
+        # but do not wait for writer lock
+        self.__readers = None
+        if int(readers) > 0:
+            self.__readers = queue.Queue(int(readers))
+
+        # intermediate commits make faces visible for readers
+        # during long runs
+        self.__commit_interval = float(commit_interval)
+        self.__last_commit = time.time()
+
+        # write-behind buffers
+        self.__buffer_size = int(buffer_size)
+        self.__flush_interval = float(flush_interval)
+        self.__faces_buffer = collections.OrderedDict()
+        self.__cache_buffer = collections.OrderedDict()
+        self.__last_flush = time.time()
+
+        # faces read by server, atime updated in batches by separate
+        # connection, so writer transaction is not affected
+        self.__touched = set()
+        self.__read_touched = set()
+        self.__touch_conn = None
+        self.__last_touch = time.time()
+
         atexit.register(self.commit)
 
     def __del__(self):
         self.commit()
 
+    def __columns(self, table):
+        return [r[1] for r in self.__conn.execute(
+            f'PRAGMA table_info({table})').fetchall()]
+
+    def __migrate(self):
+        columns = self.__columns('face_images')
+        if columns and 'atime' not in columns:
+            log.info('cachedb: add atime column')
+            self.__conn.execute(
+                'ALTER TABLE face_images ADD COLUMN "atime" INTEGER DEFAULT 0')
+            self.__conn.commit()
+
+        columns = self.__columns('cache')
+        if columns and 'id' not in columns:
+            log.info('cachedb: recreate cache table')
+            rows = self.__conn.execute(
+                'SELECT filename, face_id FROM cache').fetchall()
+            self.__conn.execute('DROP TABLE cache')
+            self.__conn.executescript(SCHEMA)
+            self.__conn.executemany(INSERT_CACHE_QUERY,
+                                    [cache_row(*r) for r in rows])
+            self.__conn.commit()
+
+    def __flush_if_needed(self):
+        if len(self.__faces_buffer) + len(self.__cache_buffer) >= \
+                self.__buffer_size or \
+                time.time() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            # buffers are dropped before writing, so a failed write is
+            # reported once and is not repeated by every next call
+            faces = self.__faces_buffer
+            cache = self.__cache_buffer
+            touched = self.__touched
+            self.__faces_buffer = collections.OrderedDict()
+            self.__cache_buffer = collections.OrderedDict()
+            self.__touched = set()
+            self.__last_flush = time.time()
+
+            c = self.__conn.cursor()
+            if faces:
+                c.executemany(INSERT_FACE_QUERY, faces.items())
+            if cache:
+                self.__insert_cache(c, cache)
+                touched.update(cache.values())
+            if touched:
+                c.executemany(TOUCH_FACE_QUERY, ((f,) for f in touched))
+            self.__commit_if_needed()
+
+    def __commit_if_needed(self):
+        if self.__commit_interval > 0 and \
+                time.time() - self.__last_commit >= self.__commit_interval:
+            log.debug('cachedb intermediate commit')
+            self.commit()
+
+    @contextlib.contextmanager
+    def __reader(self):
+        try:
+            conn = self.__readers.get_nowait()
+        except queue.Empty:
+            uri = 'file:' + urllib.request.pathname2url(
+                os.path.abspath(self.__filename)) + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            try:
+                self.__readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
     def commit(self):
         with self.__lock:
+            if self.__faces_buffer or self.__cache_buffer or self.__touched:
+                self.flush()
             self.__conn.commit()
+            self.__last_commit = time.time()
 
     def rollback(self):
         with self.__lock:
+            self.__faces_buffer.clear()
+            self.__cache_buffer.clear()
+            self.__touched.clear()
             self.__conn.rollback()
 
     def save_face(self, face_id, data):
         with self.__lock:
+            self.__faces_buffer.setdefault(face_id, data)
+            self.__flush_if_needed()
+
+    def save_faces(self, faces):
+        with self.__lock:
+            self.flush()
             c = self.__conn.cursor()
-            c.execute(
-                'INSERT INTO face_images (face_id, data) \
-                 VALUES (?, ?)', (face_id, data))
+            c.executemany(INSERT_FACE_QUERY, faces)
+            self.__commit_if_needed()
 
     def check_face(self, face_id):
         with self.__lock:
+            if face_id in self.__faces_buffer:
+                return True
             c = self.__conn.cursor()
             res = c.execute('SELECT face_id FROM face_images WHERE face_id=?',
                             (face_id,))
             return res.fetchone() is not None
 
+    def check_faces(self, face_ids):
+        with self.__lock:
+            face_ids = list(face_ids)
+            found = set(f for f in face_ids if f in self.__faces_buffer)
+            c = self.__conn.cursor()
+            for i in range(0, len(face_ids), MAX_QUERY_PARAMS):
+                chunk = face_ids[i:i + MAX_QUERY_PARAMS]
+                res = c.execute(
+                    'SELECT face_id FROM face_images WHERE face_id IN (' +
+                    ','.join('?' * len(chunk)) + ')', chunk)
+                found.update(r[0] for r in res.fetchall())
+            return found
+
     def remove_face(self, face_id):
         with self.__lock:
+            self.flush()
             c = self.__conn.cursor()
             c.execute('DELETE FROM face_images WHERE face_id=?', (face_id,))
 
-    def list_cache(self):
+    def __read_all(self, query, args=()):
+        if self.__readers is not None:
+            with self.__reader() as conn:
+                return conn.execute(query, args).fetchall()
+
         with self.__lock:
-            self.commit()
-            c = self.__conn.cursor()
-            res = c.execute('SELECT filename FROM cache')
-            return [r[0] for r in res.fetchall()]
+            self.flush()
+            return self.__conn.execute(query, args).fetchall()
+
+    def list_cache(self):
+        return [r[0] for r in self.__read_all('SELECT filename FROM cache')]
+
+    def list_cache_names(self):
+        # [(name, count, first filename), ...]
+        return self.__read_all(
+            'SELECT name, COUNT(*), MIN(filename) FROM cache \
+             GROUP BY name ORDER BY name')
+
+    def list_cache_page(self, name, offset, limit, sort_by_date=False):
+        order = 'sort_key' if sort_by_date else 'filename'
+        res = self.__read_all(
+            f'SELECT filename FROM cache WHERE name=? \
+              ORDER BY {order} LIMIT ? OFFSET ?', (name, limit, offset))
+        return [r[0] for r in res]
+
+    def list_cache_since(self, last_id):
+        # [(id, filename), ...] added after last_id
+        return self.__read_all(
+            'SELECT id, filename FROM cache WHERE id>? ORDER BY id',
+            (last_id,))
+
+    def last_cache_id(self):
+        row = self.__read('SELECT MAX(id) FROM cache')
+        return row[0] or 0
+
+    def __next_generation(self, c):
+        # cache generation is a part of HTTP validators, it is changed
+        # when cache rows are removed
+        c.execute('INSERT OR REPLACE INTO info (key, value) \
+                   VALUES (?, 1 + COALESCE( \
+                   (SELECT value FROM info WHERE key=?), 0))',
+                  ('generation', 'generation'))
+
+    def __insert_cache(self, c, files):
+        # listed file with another face changes the generation,
+        # so clients reload the list
+        filenames = list(files)
+        replaced = False
+        for i in range(0, len(filenames), MAX_QUERY_PARAMS):
+            chunk = filenames[i:i + MAX_QUERY_PARAMS]
+            res = c.execute(
+                'SELECT filename, face_id FROM cache WHERE filename IN (' +
+                ','.join('?' * len(chunk)) + ')', chunk)
+            replaced = replaced or \
+                any(files[f] != face_id for f, face_id in res.fetchall())
+        c.executemany(INSERT_CACHE_QUERY,
+                      [cache_row(*r) for r in files.items()])
+        if replaced:
+            self.__next_generation(c)
 
     def clean_cache(self):
         with self.__lock:
+            self.__cache_buffer.clear()
             self.commit()
             c = self.__conn.cursor()
             c.execute('DELETE FROM cache')
+            self.__next_generation(c)
             self.commit()
 
+    def __read(self, query, args=()):
+        if self.__readers is not None:
+            with self.__reader() as conn:
+                return conn.execute(query, args).fetchone()
+
+        with self.__lock:
+            self.flush()
+            return self.__conn.execute(query, args).fetchone()
+
+    def generation(self):
+        row = self.__read('SELECT value FROM info WHERE key=?',
+                          ('generation',))
+        return row[0] if row is not None else 0
+
+    def get_cache_face_id(self, filename):
+        row = self.__read('SELECT face_id FROM cache WHERE filename=?',
+                          (filename,))
+        return row[0] if row is not None else None
+
     def add_to_cache(self, face_id, filename):
         with self.__lock:
+            self.__cache_buffer.pop(filename, None)
+            self.__cache_buffer[filename] = face_id
+            self.__flush_if_needed()
+
+    def add_faces_to_cache(self, files):
+        with self.__lock:
+            self.flush()
             c = self.__conn.cursor()
-            c.execute(
-                'INSERT OR REPLACE INTO cache (face_id, filename) \
-                 VALUES (?, ?)', (face_id, filename))
+            files = list(files)
+            self.__insert_cache(c, {f[1]: f[0] for f in files})
+            c.executemany(TOUCH_FACE_QUERY, ((f[0],) for f in files))
+            self.__commit_if_needed()
+
+    def __touch_face(self, face_id):
+        with self.__lock:
+            self.__read_touched.add(face_id)
+            if len(self.__read_touched) < self.__buffer_size and \
+                    time.time() - self.__last_touch < self.__flush_interval:
+                return
+            self.__last_touch = time.time()
+            if self.__touch_conn is None:
+                # atime is not important enough to wait for other
+                # writers, try next time
+                self.__touch_conn = sqlite3.connect(
+                    self.__filename, timeout=0, check_same_thread=False)
+            try:
+                with self.__touch_conn:
+                    self.__touch_conn.executemany(
+                        TOUCH_FACE_QUERY,
+                        [(f,) for f in self.__read_touched])
+                self.__read_touched.clear()
+            except sqlite3.OperationalError as ex:
+                log.debug(f'cachedb atime update postponed: {ex}')
 
     def get_from_cache(self, filename):
+        if self.__readers is not None:
+            with self.__reader() as conn:
+                res = conn.execute(GET_FROM_CACHE_QUERY, (filename,))
+                row = res.fetchone()
+            if row is None:
+                return None
+            self.__touch_face(row[1])
+            return row[0]
+
         with self.__lock:
+            self.flush()
             c = self.__conn.cursor()
-            res = c.execute('SELECT data FROM face_images \
-                             JOIN cache ON face_images.face_id=cache.face_id \
-                             WHERE filename=?', (filename,))
+            res = c.execute(GET_FROM_CACHE_QUERY, (filename,))
             row = res.fetchone()
             if row is not None:
+                self.__touched.add(row[1])
                 return row[0]
             else:
                 return None
@@ -108,30 +411,139 @@ class CacheDB(object):
 
     def remove_from_cache(self, filename):
         with self.__lock:
+            self.flush()
             c = self.__conn.cursor()
             c.execute('DELETE FROM cache WHERE filename=?', (filename,))
 
+    def __remove_orphans(self, recdb_file):
+        # ATTACH/DETACH are not allowed inside transaction
+        self.commit()
+        self.__conn.execute('ATTACH DATABASE ? AS rec', (recdb_file,))
+        try:
+            c = self.__conn.cursor()
+            count = c.execute(
+                'DELETE FROM face_images WHERE face_id NOT IN \
+                 (SELECT id FROM rec.faces)').rowcount
+            self.commit()
+        finally:
+            self.__conn.execute('DETACH DATABASE rec')
+        return count
+
+    def __evict(self, max_size):
+        c = self.__conn.cursor()
+        # cheap check by file size before full table scan
+        pages = c.execute('PRAGMA page_count').fetchone()[0] - \
+            c.execute('PRAGMA freelist_count').fetchone()[0]
+        if pages * c.execute('PRAGMA page_size').fetchone()[0] <= max_size:
+            return 0
+        size = c.execute(
+            'SELECT COALESCE(SUM(LENGTH(data)), 0) FROM face_images'
+        ).fetchone()[0]
+        if size <= max_size:
+            return 0
+
+        # faces listed in cache are shown in UI and are not evicted
+        res = c.execute(
+            'SELECT face_id, LENGTH(data) FROM face_images \
+             WHERE face_id NOT IN (SELECT face_id FROM cache) \
+             ORDER BY atime')
+        face_ids = []
+        for face_id, length in res:
+            if size <= max_size:
+                break
+            face_ids.append((face_id,))
+            size -= length
+        c.executemany('DELETE FROM face_images WHERE face_id=?', face_ids)
+        return len(face_ids)
+
+    def gc(self, recdb_file=None, max_size=None):
+        if max_size is None:
+            max_size = self.__max_size
+        with self.__lock:
+            orphans = 0
+            if recdb_file:
+                orphans = self.__remove_orphans(recdb_file)
+
+            evicted = 0
+            if max_size > 0:
+                evicted = self.__evict(max_size)
 
-def __speed_test(db):
-    data = 'z' * 4000
-    count = 1000
-    for i in range(count):
-        db.save_face(i, data)
-    del db
+            c = self.__conn.cursor()
+            removed = c.execute('DELETE FROM cache WHERE face_id NOT IN \
+                                 (SELECT face_id FROM face_images)').rowcount
+            if removed:
+                self.__next_generation(c)
+            self.commit()
 
+            auto_vacuum = c.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if auto_vacuum != 2:
+                # full vacuum blocks database for long time
+                log.warning('cachedb: free pages are not released, '
+                            'run cachedb.py -a vacuum')
+            else:
+                c.execute('PRAGMA incremental_vacuum').fetchall()
+            log.info(f'cachedb gc: {orphans} orphans, {evicted} evicted')
+            return orphans, evicted
 
-def speed_test(db):
+    def vacuum(self):
+        with self.__lock:
+            self.commit()
+            # database created before incremental vacuum is converted
+            log.info('cachedb: vacuum')
+            c = self.__conn.cursor()
+            c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            c.execute('VACUUM')
+
+
+def __speed_test(db, count):
+    data = b'z' * 4000
+    face_ids = range(-count, 0)
+
+    def single():
+        for i in face_ids:
+            if not db.check_face(i):
+                db.save_face(i, data)
+                db.flush()
+                db.add_to_cache(i, f'speed_test/{i}.jpg')
+                db.flush()
+
+    def buffered():
+        for i in face_ids:
+            if not db.check_face(i):
+                db.save_face(i, data)
+                db.add_to_cache(i, f'speed_test/{i}.jpg')
+        db.flush()
+
+    def batched():
+        found = db.check_faces(face_ids)
+        db.save_faces([(i, data) for i in face_ids if i not in found])
+        db.add_faces_to_cache([(i, f'speed_test/{i}.jpg') for i in face_ids])
+
+    for test in (single, buffered, batched):
+        start = time.time()
+        test()
+        print(f'{test.__name__}: {count} faces, '
+              f'{time.time() - start:.3f} sec')
+        db.rollback()
+
+
+def speed_test(db, count=10000):
     import cProfile
 
-    cProfile.runctx('__speed_test(db)',
-                    {'__speed_test': __speed_test, 'db': db}, {})
+    cProfile.runctx('__speed_test(db, count)',
+                    {'__speed_test': __speed_test, 'db': db, 'count': count},
+                    {})
 
 
-def createCacheDB(cfg):
+def createCacheDB(cfg, readers=0):
     cachedb_file = cfg.get_path('files', 'cachedb')
     if cachedb_file:
         log.info(f'Using cachedb: {cachedb_file}')
-        return CacheDB(cachedb_file)
+        return CacheDB(
+            cachedb_file,
+            max_size=cfg['processing']['cachedb_max_size'],
+            commit_interval=cfg['processing']['cachedb_commit_interval'],
+            readers=readers)
     else:
         log.info(f'Not using cachedb')
         return None
@@ -145,10 +557,15 @@ def args_parse():
                  'list_cache',
                  'save_file',
                  'remove_from_cache',
+                 'gc',
+                 'vacuum',
                  'speed_test'])
     parser.add_argument('-d', '--database', help='Database file')
     parser.add_argument('-f', '--file', help='File name')
     parser.add_argument('-o', '--out-file', help='Out file name')
+    parser.add_argument('-r', '--recdb', help='Recognition database file')
+    parser.add_argument('-s', '--max-size', help='Maximum size (MB)',
+                        type=int, default=0)
     return parser.parse_args()
 
 
@@ -165,6 +582,10 @@ def main():
         db.save_from_cache(args.file, args.out_file)
     elif args.action == 'remove_from_cache':
         db.remove_from_cache(args.file)
+    elif args.action == 'gc':
+        db.gc(args.recdb, args.max_size * 1024 * 1024)
+    elif args.action == 'vacuum':
+        db.vacuum()
     elif args.action == 'speed_test':
         speed_test(db)
 
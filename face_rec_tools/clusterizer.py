@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import numpy
+import argparse
+import resource
+
+sys.path.insert(0, os.path.abspath('..'))
+
+from face_rec_tools import log  # noqa
+
+METHOD_CHINESE_WHISPERS = 'chinese_whispers'
+METHOD_CONNECTED_COMPONENTS = 'connected_components'
+
+
+class Clusterizer(object):
+    def __init__(self,
+                 threshold,
+                 method=METHOD_CHINESE_WHISPERS,
+                 neighbors=50,
+                 block_memory=256,
+                 iterations=100):
+
+        if method not in (METHOD_CHINESE_WHISPERS,
+                          METHOD_CONNECTED_COMPONENTS):
+            raise ValueError("Invalid clusterize method: ", method)
+
+        self.__threshold = float(threshold)
+        self.__method = method
+        self.__neighbors = int(neighbors)
+        self.__block_memory = int(block_memory) * 1024 * 1024
+        self.__iterations = int(iterations)
+        self.__random = numpy.random.RandomState(0)
+
+    def __log_stage(self, stage, start, details=''):
+        elapsed = time.time() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        log.info(f'clusterize {stage}: {elapsed:.2f} sec, '
+                 f'max rss: {rss} MB {details}')
+
+    def __neighbors_graph(self, encs):
+        count = len(encs)
+        sq = numpy.einsum('ij,ij->i', encs, encs)
+        threshold2 = self.__threshold ** 2
+
+        # distance matrix block (and its temporary mask)
+        # must fit to block_memory
+        rows = max(1, self.__block_memory // (count * (encs.itemsize + 1)))
+
+        src = []
+        dst = []
+        for i in range(0, count, rows):
+            dist2 = numpy.dot(encs[i:i + rows], encs.T)
+            dist2 *= -2
+            dist2 += sq[None, :]
+            dist2 += sq[i:i + rows, None]
+            dist2[numpy.arange(len(dist2)), numpy.arange(i, i + len(dist2))] \
+                = threshold2
+
+            block_src, block_dst = numpy.nonzero(dist2 < threshold2)
+
+            # keep only nearest neighbors for each face
+            order = numpy.lexsort((dist2[block_src, block_dst], block_src))
+            block_src = block_src[order]
+            block_dst = block_dst[order]
+            first = numpy.searchsorted(block_src, block_src)
+            nearest = numpy.arange(len(block_src)) - first < self.__neighbors
+
+            src.append(block_src[nearest] + i)
+            dst.append(block_dst[nearest])
+
+        src = numpy.concatenate(src)
+        dst = numpy.concatenate(dst)
+
+        # make graph undirected and remove duplicated edges
+        keys = numpy.unique(numpy.concatenate((
+            src.astype(numpy.int64) * count + dst,
+            dst.astype(numpy.int64) * count + src)))
+        return keys // count, keys % count
+
+    def __chinese_whispers(self, count, src, dst):
+        labels = numpy.arange(count)
+        if len(src) == 0:
+            return labels
+        for i in range(self.__iterations):
+            # count neighbors labels for each node
+            keys, weights = numpy.unique(src * count + labels[dst],
+                                         return_counts=True)
+            nodes = keys // count
+
+            # choose most frequent label, ties are broken randomly,
+            # but current label of node wins a tie
+            current = labels[nodes] == keys % count
+            weights = weights + 0.5 * current + \
+                0.5 * self.__random.random_sample(len(weights))
+            order = numpy.lexsort((weights, nodes))
+            last = numpy.append(nodes[order][1:] != nodes[order][:-1], True)
+            best = order[last]
+
+            # converged when no node would change its label
+            pending = keys[best] % count != labels[nodes[best]]
+            log.debug(f'chinese whispers iteration {i}: '
+                      f'{numpy.count_nonzero(pending)} pending')
+            if not pending.any():
+                break
+
+            # update only random half of nodes to avoid oscillation
+            update = pending & \
+                (self.__random.random_sample(len(best)) < 0.5)
+            labels = labels.copy()
+            labels[nodes[best][update]] = keys[best][update] % count
+        return labels
+
+    def __connected_components(self, count, src, dst):
+        labels = numpy.arange(count)
+        while True:
+            new_labels = labels.copy()
+            numpy.minimum.at(new_labels, src, labels[dst])
+            # pointer jumping
+            while True:
+                jumped = new_labels[new_labels]
+                if numpy.array_equal(jumped, new_labels):
+                    break
+                new_labels = jumped
+            if numpy.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+        return labels
+
+    def nearest(self, encodings, centroids):
+        encs = numpy.array(encodings, dtype=numpy.float32)
+        cents = numpy.array(centroids, dtype=numpy.float32)
+        if len(encs) == 0 or len(cents) == 0:
+            return numpy.zeros(len(encs), dtype=numpy.int64), \
+                numpy.full(len(encs), numpy.inf)
+
+        sq = numpy.einsum('ij,ij->i', cents, cents)
+        rows = max(1, self.__block_memory // (len(cents) * encs.itemsize))
+
+        indexes = []
+        dists = []
+        for i in range(0, len(encs), rows):
+            block = encs[i:i + rows]
+            dist2 = numpy.dot(block, cents.T)
+            dist2 *= -2
+            dist2 += sq[None, :]
+            dist2 += numpy.einsum('ij,ij->i', block, block)[:, None]
+            nearest = numpy.argmin(dist2, axis=1)
+            indexes.append(nearest)
+            dists.append(numpy.sqrt(numpy.maximum(
+                dist2[numpy.arange(len(block)), nearest], 0)))
+        return numpy.concatenate(indexes), numpy.concatenate(dists)
+
+    def clusterize(self, encodings):
+        count = len(encodings)
+        if count == 0:
+            return []
+
+        start = time.time()
+        encs = numpy.array(encodings, dtype=numpy.float32)
+        self.__log_stage('prepare', start,
+                         f'({count} faces, {encs.nbytes // 1024} KB)')
+
+        start = time.time()
+        src, dst = self.__neighbors_graph(encs)
+        self.__log_stage('neighbors graph', start, f'({len(src)} edges)')
+
+        start = time.time()
+        if self.__method == METHOD_CHINESE_WHISPERS:
+            labels = self.__chinese_whispers(count, src, dst)
+        else:
+            labels = self.__connected_components(count, src, dst)
+        labels = numpy.unique(labels, return_inverse=True)[1]
+        self.__log_stage(self.__method, start,
+                         f'({labels.max() + 1} clusters)')
+
+        return labels.tolist()
+
+
+def speed_test(count, dimension, threshold, method, neighbors):
+    rnd = numpy.random.RandomState(0)
+    centers = rnd.normal(size=(count // 10 + 1, dimension))
+    encs = centers[rnd.randint(len(centers), size=count)] + \
+        rnd.normal(scale=0.01, size=(count, dimension))
+
+    clusterizer = Clusterizer(threshold, method, neighbors)
+    start = time.time()
+    labels = clusterizer.clusterize(encs)
+    print(f'{count} faces, {max(labels) + 1} clusters, '
+          f'{time.time() - start:.2f} sec')
+
+
+def args_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--action', help='Action', required=True,
+        choices=['speed_test'])
+    parser.add_argument('-n', '--count', help='Faces count',
+                        type=int, default=100000)
+    parser.add_argument('-d', '--dimension', help='Encoding dimension',
+                        type=int, default=128)
+    parser.add_argument('-t', '--threshold', help='Clusterize threshold',
+                        type=float, default=0.4)
+    parser.add_argument('-m', '--method', help='Clusterize method',
+                        default=METHOD_CHINESE_WHISPERS,
+                        choices=[METHOD_CHINESE_WHISPERS,
+                                 METHOD_CONNECTED_COMPONENTS])
+    parser.add_argument('-k', '--neighbors', help='Neighbors count',
+                        type=int, default=50)
+    parser.add_argument('-l', '--logfile', help='Log file')
+    return parser.parse_args()
+
+
+def main():
+    args = args_parse()
+    log.initLogger(args.logfile)
+
+    if args.action == 'speed_test':
+        speed_test(args.count, args.dimension, args.threshold,
+                   args.method, args.neighbors)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+import numpy
+import unittest
+
+import clusterizer
+
+
+class TestClusterizer(unittest.TestCase):
+    def blobs(self, seed, count=5, size=300):
+        rnd = numpy.random.RandomState(seed)
+        centers = rnd.normal(size=(count, 128))
+        return numpy.repeat(centers, size, axis=0) + \
+            rnd.normal(scale=0.01, size=(count * size, 128))
+
+    def test_chinese_whispers_blobs(self):
+        for seed in range(10):
+            labels = clusterizer.Clusterizer(0.4).clusterize(self.blobs(seed))
+            self.assertEqual(5, max(labels) + 1)
+            for i in range(5):
+                self.assertEqual(1, len(set(labels[i * 300:(i + 1) * 300])))
+
+    def test_connected_components_blobs(self):
+        labels = clusterizer.Clusterizer(
+            0.4, clusterizer.METHOD_CONNECTED_COMPONENTS).clusterize(
+                self.blobs(0))
+        self.assertEqual(5, max(labels) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,10 +12,14 @@ class Config(object):
             'encoding_model': 'large',
             'distance_metric': 'default',
             'num_jitters': 100,
+            'adaptive_jitters': 0,
+            'adaptive_jitters_band': 0.05,
             'threshold': 0.3,
             'threshold_weak': 0.35,
             'threshold_clusterize': 0.4,
             'threshold_equal': 0.17,
+            'clusterize_method': 'chinese_whispers',
+            'clusterize_neighbors': 50,
             'min_face_size': 20,  # pixels
             'max_face_profile_angle': 90,  # degries
             'min_video_face_count': 3,
@@ -26,12 +30,20 @@ class Config(object):
             'max_video_frames': 3600,  # 2 min
             'video_frames_step': 10,
             'video_batch_size': 8,
+            'encoding_batch_size': 32,
             'max_workers': 2,
             'cuda_memory_limit': 1536,  # MB
+            'clusterize_block_memory': 256,  # MB
+            'media_cache_memory': 512,  # MB
+            'face_save_workers': 2,
+            'face_save_queue_size': 64,
+            'cachedb_commit_interval': 30,  # seconds
+            'cachedb_max_size': 1024,  # MB
         },
         'files': {
             'db': 'face-rec/rec.db',
             'cachedb': 'face-rec/cache.db',
+            'jobsdb': 'face-rec/jobs.db',
             'patterns': 'face-rec/patterns/',
             'nomedia_files': '.plexignore:.nomedia',
         },
@@ -39,6 +51,13 @@ class Config(object):
             'port': 8081,
             'web_path': 'web',
             'face_cache_path': '/tmp/facereccache/',
+            'overlay_cache_size': 256,
+            'sprite_cache_size': 16,
+            'preview_cache_path': '/tmp/facerecpreview/',
+            'preview_cache_size': 256,
+            'cachedb_readers': 4,
+            'status_interval': 1,
+            'status_streams': 8,
             'log_file': 'face-rec/face-rec-server.log',
         },
         'plex': {
@@ -1,8 +1,6 @@
 #!/usr/bin/python3
 
 import sys
-import pickle
-import piexif
 import face_recognition
 
 import tools
@@ -13,13 +11,10 @@ encoder = faceencoder.FaceEncoder('large', 'default', align=True)
 
 
 def get_face(fname):
-    try:
-        encoding = pickle.loads(
-            piexif.load(fname)["0th"][piexif.ImageIFD.ImageDescription])
+    descr = tools.load_face_description(fname)[0]
+    if descr is not None and descr.get('encoding') is not None:
         print('Use cached: ' + fname)
-        return encoding['encoding']
-    except Exception:
-        pass
+        return descr['encoding']
     try:
         image = tools.read_image(fname, 1000)
     except Exception:
@@ -4,8 +4,10 @@ import os
 import cv2
 import sys
 import math
+import time
+import argparse
+import importlib
 import numpy as np
-import face_recognition
 
 sys.path.insert(0, os.path.abspath('..'))
 
@@ -25,20 +27,31 @@ PRED_TYPES = {'face': slice(0, 17),
               }
 
 
+def face_distance(encodings, encoding):
+    if len(encodings) == 0:
+        return np.empty((0))
+    return np.linalg.norm(encodings - encoding, axis=1)
+
+
 class FaceEncoder(object):
     def __init__(self,
                  encoding_model='large',
                  distance_metric='default',
                  num_jitters=1,
                  align=True,
-                 debug_out_folder=None):
+                 debug_out_folder=None,
+                 batch_size=32):
 
         log.info(f"Using {encoding_model} model and {distance_metric} metric")
 
         self.__encoding_model = encoding_model
         self.__num_jitters = int(num_jitters)
+        self.__batch_size = int(batch_size)
         self.__debug_out_folder = debug_out_folder
         self.__debug_out_counter = 0
+        self.__model = None
+        self.__model_module = None
+        self.__aligner = None
 
         if encoding_model == 'small':
             self.__encode = self.__encode_face_recognition
@@ -46,30 +59,26 @@ class FaceEncoder(object):
         elif encoding_model == 'large':
             self.__encode = self.__encode_face_recognition
         elif encoding_model == 'VGG-Face':
-            from deepface.basemodels import VGGFace
-            self.__model = VGGFace.loadModel()
+            self.__model_module = 'deepface.basemodels.VGGFace'
             self.__encode = self.__encode_deepface
             self.__input_shape = (224, 224)
         elif encoding_model == 'OpenFace':
-            from deepface.basemodels import OpenFace
-            self.__model = OpenFace.loadModel()
+            self.__model_module = 'deepface.basemodels.OpenFace'
             self.__encode = self.__encode_deepface
             self.__input_shape = (96, 96)
         elif encoding_model == 'Facenet':
-            from deepface.basemodels import Facenet
-            self.__model = Facenet.loadModel()
+            self.__model_module = 'deepface.basemodels.Facenet'
             self.__encode = self.__encode_deepface
             self.__input_shape = (160, 160)
         elif encoding_model == 'DeepFace':
-            from deepface.basemodels import FbDeepFace
-            self.__model = FbDeepFace.loadModel()
+            self.__model_module = 'deepface.basemodels.FbDeepFace'
             self.__encode = self.__encode_deepface
             self.__input_shape = (152, 152)
         else:
             raise ValueError("Invalid model_name: ", encoding_model)
 
         if distance_metric == 'default':
-            self.__distance = face_recognition.face_distance
+            self.__distance = face_distance
         elif distance_metric == 'cosine':
             from deepface.commons import distance
             self.__distance = lambda encodings, encoding: \
@@ -88,14 +97,24 @@ class FaceEncoder(object):
         else:
             raise ValueError("Invalid distance_metric: ", distance_metric)
 
-        if align:
+        self.__use_aligner = align
+
+    def __get_model(self):
+        if self.__model is None:
+            log.info(f'Loading {self.__encoding_model} model')
+            module = importlib.import_module(self.__model_module)
+            self.__model = module.loadModel()
+        return self.__model
+
+    def __get_aligner(self):
+        if self.__aligner is None:
             import face_alignment
+            log.info('Loading face alignment model')
             self.__aligner = face_alignment.FaceAlignment(
                 face_alignment.LandmarksType._3D,
                 device='cuda' if tools.has_cuda() else 'cpu',
                 flip_input=True)
-        else:
-            self.__aligner = None
+        return self.__aligner
 
     def __save_debug(self, image):
         if self.__debug_out_folder is None:
@@ -181,61 +200,199 @@ class FaceEncoder(object):
     def __profile_angles(self, preds):
         return [self.__get_eyes_angle(pred) for pred in preds]
 
-    def __encode_deepface(self, image, boxes):
-        from tensorflow.keras.preprocessing import image as keras_image
-
-        res = []
-        if self.__aligner is not None:
-            preds = self.__aligner.get_landmarks_from_image(
+    def __get_deepface_landmarks(self, image, boxes):
+        if self.__use_aligner:
+            preds = self.__get_aligner().get_landmarks_from_image(
                 image, self.__aligner_boxes(boxes))
             landmarks = self.__convert_to_landmarks(
                 self.__convert_to_2D(preds))
         else:
             preds = [None] * len(boxes)
             landmarks = [{}] * len(boxes)
+        return preds, landmarks
 
-        for box, pred in zip(boxes, preds):
-            if self.__aligner is not None:
-                sub_image = self.__align(
-                    image, self.__aligner_boxes((box,))[0], pred)
-                self.__save_debug(sub_image)
-            else:
-                top, right, bottom, left = box
-                sub_image = image[top:bottom, left:right]
-                sub_image = cv2.resize(sub_image, self.__input_shape)
-                self.__save_debug(sub_image)
-            img_pixels = keras_image.img_to_array(sub_image)
-            img_pixels = np.expand_dims(img_pixels, axis=0)
-            img_pixels /= 255
-            res.append(self.__model.predict(img_pixels)[0, :])
-        return res, landmarks, self.__profile_angles(preds)
-
-    def __encode_face_recognition(self, image, boxes):
+    def __get_deepface_sub_image(self, image, box, pred):
+        if self.__use_aligner:
+            sub_image = self.__align(
+                image, self.__aligner_boxes((box,))[0], pred)
+        else:
+            top, right, bottom, left = box
+            sub_image = image[top:bottom, left:right]
+            sub_image = cv2.resize(sub_image, self.__input_shape)
+        self.__save_debug(sub_image)
+        return sub_image
+
+    def __predict_deepface(self, sub_images):
+        if len(sub_images) == 0:
+            return []
+        img_pixels = np.array(sub_images, dtype=np.float32)
+        img_pixels /= 255
+        res = self.__get_model().predict(img_pixels,
+                                         batch_size=self.__batch_size)
+        return list(res)
+
+    def __encode_deepface_batch(self, images, boxes_list, num_jitters):
+        sub_images = []
+        res = []
+        for image, boxes in zip(images, boxes_list):
+            if len(boxes) == 0:
+                res.append(([], [], []))
+                continue
+            preds, landmarks = self.__get_deepface_landmarks(image, boxes)
+            for box, pred in zip(boxes, preds):
+                sub_images.append(
+                    self.__get_deepface_sub_image(image, box, pred))
+            res.append((None, landmarks, self.__profile_angles(preds)))
+
+        # one predict call for all faces of all images
+        encodings = self.__predict_deepface(sub_images)
+
+        pos = 0
+        for i, boxes in enumerate(boxes_list):
+            if res[i][0] is not None:
+                continue
+            res[i] = (encodings[pos:pos + len(boxes)],) + res[i][1:]
+            pos += len(boxes)
+        return res
+
+    def __encode_deepface(self, image, boxes, num_jitters):
+        return self.__encode_deepface_batch(
+            (image,), (boxes,), num_jitters)[0]
+
+    def __get_shapes(self, image, boxes, preds2d):
+        import dlib
+        from face_recognition import api
+        if preds2d is not None:
+            return [dlib.full_object_detection(
+                api._css_to_rect(box),
+                [dlib.point(x, y) for x, y in pts])
+                for box, pts in zip(boxes, preds2d)]
+
+        if self.__encoding_model == 'small':
+            predictor = api.pose_predictor_5_point
+        else:
+            predictor = api.pose_predictor_68_point
+        return [predictor(image, api._css_to_rect(box)) for box in boxes]
+
+    def __shape_to_landmarks(self, shape):
+        points = [(p.x, p.y) for p in shape.parts()]
+        if self.__encoding_model == 'small':
+            return {
+                "nose_tip": [points[4]],
+                "left_eye": points[2:4],
+                "right_eye": points[0:2]}
+        return {
+            "chin": points[0:17],
+            "left_eyebrow": points[17:22],
+            "right_eyebrow": points[22:27],
+            "nose_bridge": points[27:31],
+            "nose_tip": points[31:36],
+            "left_eye": points[36:42],
+            "right_eye": points[42:48],
+            "top_lip": points[48:55] + [points[64]] + [points[63]] +
+            [points[62]] + [points[61]] + [points[60]],
+            "bottom_lip": points[54:60] + [points[48]] + [points[60]] +
+            [points[67]] + [points[66]] + [points[65]] + [points[64]]}
+
+    def __encode_face_recognition(self, image, boxes, num_jitters):
         if len(boxes) == 0:
             return [], [], []
-        if self.__aligner is not None:
-            preds = self.__aligner.get_landmarks_from_image(
+        if self.__use_aligner:
+            preds = self.__get_aligner().get_landmarks_from_image(
                 image, self.__aligner_boxes(boxes))
             preds2d = self.__convert_to_2D(preds)
         else:
             preds = [None] * len(boxes)
             preds2d = None
 
-        encodings = face_recognition.face_encodings(
-            image, boxes, self.__num_jitters,
-            model=self.__encoding_model,
-            landmark_points=preds2d)
+        # landmark shapes calculated once and used for encodings
+        # and for landmarks (the same as face_recognition does inside
+        # face_encodings and face_landmarks)
+        shapes = self.__get_shapes(image, boxes, preds2d)
+
+        from face_recognition import api
+        encoder = api.face_encoder
+        encodings = [np.array(encoder.compute_face_descriptor(
+            image, shape, num_jitters)) for shape in shapes]
 
-        landmarks = face_recognition.face_landmarks(
-            image,
-            face_locations=boxes,
-            model=self.__encoding_model,
-            landmark_points=preds2d)
+        landmarks = [self.__shape_to_landmarks(shape) for shape in shapes]
 
         return encodings, landmarks, self.__profile_angles(preds)
 
-    def encode(self, image, boxes):
-        return self.__encode(image, boxes)
+    def encode(self, image, boxes, num_jitters=None):
+        if num_jitters is None:
+            num_jitters = self.__num_jitters
+        return self.__encode(image, boxes, num_jitters)
+
+    def encode_batch(self, images, boxes_list, num_jitters=None):
+        if num_jitters is None:
+            num_jitters = self.__num_jitters
+        if self.__encode == self.__encode_deepface:
+            return self.__encode_deepface_batch(
+                images, boxes_list, num_jitters)
+        return [self.__encode(image, boxes, num_jitters)
+                for image, boxes in zip(images, boxes_list)]
 
     def distance(self, encodings, encoding):
         return self.__distance(encodings, encoding)
+
+
+def speed_test(image_file, encoding_model, num_jitters, count):
+    import face_recognition
+
+    image = tools.read_image(image_file, 1000)
+    boxes = face_recognition.face_locations(image, model='hog')
+    if len(boxes) == 0:
+        print(f'No faces found in {image_file}')
+        return
+    faces = len(boxes) * count
+    print(f'{len(boxes)} faces, {count} iterations')
+
+    # without aligner for compare the same landmarks source
+    encoder = FaceEncoder(encoding_model=encoding_model,
+                          num_jitters=num_jitters,
+                          align=False)
+
+    start = time.time()
+    for i in range(count):
+        face_recognition.face_encodings(
+            image, boxes, num_jitters, model=encoding_model)
+        face_recognition.face_landmarks(
+            image, face_locations=boxes, model=encoding_model)
+    elapsed = time.time() - start
+    print(f'face_encodings + face_landmarks: '
+          f'{elapsed / faces * 1000:.2f} ms per face')
+
+    start = time.time()
+    for i in range(count):
+        encoder.encode(image, boxes)
+    elapsed = time.time() - start
+    print(f'FaceEncoder.encode: {elapsed / faces * 1000:.2f} ms per face')
+
+
+def args_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--action', help='Action', required=True,
+        choices=['speed_test'])
+    parser.add_argument('-i', '--input', help='Image file', required=True)
+    parser.add_argument('-m', '--encoding-model', help='Encoding model',
+                        default='large', choices=['small', 'large'])
+    parser.add_argument('-j', '--num-jitters', help='Jitters count',
+                        type=int, default=1)
+    parser.add_argument('-n', '--count', help='Iterations count',
+                        type=int, default=10)
+    return parser.parse_args()
+
+
+def main():
+    args = args_parse()
+    log.initLogger()
+
+    if args.action == 'speed_test':
+        speed_test(args.input, args.encoding_model,
+                   args.num_jitters, args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import io
+import os
+import sys
+import queue
+import threading
+import concurrent.futures
+
+sys.path.insert(0, os.path.abspath('..'))
+
+from face_rec_tools import log  # noqa
+from face_rec_tools import tools  # noqa
+
+# count of queued writes which are written to cachedb together
+WRITE_BATCH_SIZE = 256
+
+
+class FaceSaver(object):
+    def __init__(self, cdb, out_size, max_workers=2, queue_size=64):
+        self.__cdb = cdb
+        self.__out_size = int(out_size)
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(max_workers))
+        self.__slots = threading.BoundedSemaphore(int(queue_size))
+        self.__lock = threading.Lock()
+        self.__pending = set()
+        self.__results = queue.Queue()
+        self.__writer = threading.Thread(target=self.__write_loop,
+                                         daemon=True)
+        self.__writer.start()
+
+    def __write_loop(self):
+        # the only thread which writes faces to cachedb or to disk
+        while True:
+            writes = [self.__results.get()]
+            # ready writes are written to cachedb by batch queries
+            while len(writes) < WRITE_BATCH_SIZE:
+                try:
+                    writes.append(self.__results.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.__write(writes)
+            except Exception:
+                log.exception('face writing failed')
+            finally:
+                for w in writes:
+                    self.__results.task_done()
+
+    def __render(self, face_image, face_box, enc, src_filename):
+        out_stream = io.BytesIO()
+        tools.save_face_image(out_stream, face_image, face_box, enc,
+                              self.__out_size, src_filename)
+        return out_stream.getvalue()
+
+    def __write(self, writes):
+        faces = []
+        files = []
+        try:
+            # writes are in submission order, the writer waits for
+            # rendering of each face
+            for future, out_filename, face_id, cache_filename in writes:
+                try:
+                    if future is not None:
+                        data = future.result()
+                        if out_filename is not None:
+                            with open(out_filename, 'wb') as f:
+                                f.write(data)
+                            log.debug(f'face saved to: {out_filename}')
+                        else:
+                            faces.append((face_id, data))
+                    if cache_filename is not None:
+                        files.append((face_id, cache_filename))
+                except Exception:
+                    log.exception('face writing failed')
+            if faces:
+                self.__cdb.save_faces(faces)
+                log.debug(f'{len(faces)} faces cached')
+            if files:
+                self.__cdb.add_faces_to_cache(files)
+        finally:
+            with self.__lock:
+                for future, out_filename, face_id, cache_filename in writes:
+                    if future is not None and out_filename is None:
+                        self.__pending.discard(face_id)
+            for future, out_filename, face_id, cache_filename in writes:
+                if future is not None:
+                    self.__slots.release()
+
+    def __submit(self, image, enc, src_filename, *args):
+        face_image, face_box = tools.crop_face(image, enc['box'])
+        # copy, the source image can be released before rendering
+        face_image = face_image.copy()
+        self.__slots.acquire()
+        future = self.__executor.submit(self.__render, face_image, face_box,
+                                        enc, src_filename)
+        self.__results.put((future,) + args)
+
+    def save_to_file(self, out_filename, image, enc, src_filename):
+        self.__submit(image, enc, src_filename, out_filename, None, None)
+
+    def save_to_cache(self, image, enc, src_filename, cache_filename=None):
+        with self.__lock:
+            self.__pending.add(enc['face_id'])
+        self.__submit(image, enc, src_filename,
+                      None, enc['face_id'], cache_filename)
+
+    def add_to_cache(self, face_id, cache_filename):
+        self.__results.put((None, None, face_id, cache_filename))
+
+    def is_pending(self, face_id):
+        with self.__lock:
+            return face_id in self.__pending
+
+    def flush(self):
+        self.__results.join()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import unittest
+import subprocess
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ('face_rec_tools.recognizer',
+                'face_rec_tools.recdb',
+                'face_rec_tools.cachedb',
+                'face_rec_tools.server',
+                'face_rec_tools.patterns',
+                'face_rec_tools.plexsync')
+
+HEAVY_MODULES = ('cv2',
+                 'PIL',
+                 'dlib',
+                 'torch',
+                 'piexif',
+                 'deepface',
+                 'tensorflow',
+                 'face_alignment',
+                 'face_recognition')
+
+
+def import_time(module):
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT_PATH,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if res.returncode != 0:
+        raise Exception(res.stderr.splitlines()[-1])
+
+    # import time: self [us] | cumulative | imported package
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        times[fields[2].strip()] = cumulative
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        for module in ENTRY_POINTS:
+            with self.subTest(module=module):
+                times = import_time(module)
+                print(f'{module}: {times[module] / 1000:.1f} ms')
+                heavy = [m for m in HEAVY_MODULES if m in times]
+                self.assertEqual([], heavy)
+
+
+if __name__ == '__main__':
+    unittest.main()
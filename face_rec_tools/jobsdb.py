@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+sys.path.insert(0, os.path.abspath('..'))
+
+from face_rec_tools import log  # noqa
+
+SCHEMA = '''
+PRAGMA journal_mode=WAL;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "method" TEXT,
+    "args" TEXT,
+    "kwargs" TEXT DEFAULT '{}',
+    "priority" INTEGER,
+    "state" TEXT,
+    "preempted" INTEGER DEFAULT 0,
+    "error" TEXT,
+    "created" REAL,
+    "started" REAL,
+    "finished" REAL
+);
+
+CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority);
+'''
+
+JOB_COLUMNS = ('id', 'method', 'args', 'kwargs', 'priority', 'state',
+               'preempted', 'error', 'created', 'started', 'finished')
+
+SELECT_JOBS_QUERY = 'SELECT ' + ', '.join(JOB_COLUMNS) + ' FROM jobs '
+
+# count of finished jobs kept in database
+FINISHED_JOBS_KEEP = 100
+
+
+def job_row(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job['args'] = json.loads(job['args'])
+    job['kwargs'] = json.loads(job['kwargs'])
+    return job
+
+
+class JobsDB(object):
+    def __init__(self, filename):
+        log.debug(f'Connect to {filename}')
+        # used by server requests threads and status thread
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__migrate()
+            self.__conn.executescript(SCHEMA)
+            # jobs of stopped server are resumed
+            self.__conn.execute(
+                "UPDATE jobs SET state='queued', preempted=1 "
+                "WHERE state='running'")
+            self.__conn.commit()
+
+    def __migrate(self):
+        columns = [r[1] for r in self.__conn.execute(
+            'PRAGMA table_info(jobs)').fetchall()]
+        if columns and 'kwargs' not in columns:
+            log.info('jobsdb: add kwargs column')
+            self.__conn.execute(
+                "ALTER TABLE jobs ADD COLUMN \"kwargs\" TEXT DEFAULT '{}'")
+            self.__conn.commit()
+
+    def add(self, method, args, priority):
+        with self.__lock:
+            c = self.__conn.execute(
+                'INSERT INTO jobs (method, args, priority, state, created) '
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (method, json.dumps(args), priority, time.time()))
+            self.__conn.commit()
+            return c.lastrowid
+
+    def next(self):
+        with self.__lock:
+            row = self.__conn.execute(
+                SELECT_JOBS_QUERY + "WHERE state='queued' "
+                'ORDER BY priority DESC, id LIMIT 1').fetchone()
+        if row is None:
+            return None
+        return job_row(row)
+
+    def count_queued(self):
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()
+        return row[0]
+
+    def start(self, job_id):
+        with self.__lock:
+            self.__conn.execute(
+                "UPDATE jobs SET state='running', started=? WHERE id=?",
+                (time.time(), job_id))
+            self.__conn.commit()
+
+    def requeue(self, job_id, kwargs=None):
+        # kwargs allow preempted job to resume from where it stopped
+        with self.__lock:
+            self.__conn.execute(
+                "UPDATE jobs SET state='queued', preempted=preempted+1 "
+                'WHERE id=?', (job_id,))
+            if kwargs:
+                self.__conn.execute('UPDATE jobs SET kwargs=? WHERE id=?',
+                                    (json.dumps(kwargs), job_id))
+            self.__conn.commit()
+
+    def finish(self, job_id, state, error=None):
+        with self.__lock:
+            self.__conn.execute(
+                'UPDATE jobs SET state=?, error=?, finished=? WHERE id=?',
+                (state, error, time.time(), job_id))
+            self.__conn.execute(
+                'DELETE FROM jobs WHERE finished IS NOT NULL AND id NOT IN '
+                '(SELECT id FROM jobs WHERE finished IS NOT NULL '
+                'ORDER BY id DESC LIMIT ?)', (FINISHED_JOBS_KEEP,))
+            self.__conn.commit()
+
+    def cancel(self, job_id):
+        with self.__lock:
+            c = self.__conn.execute(
+                "UPDATE jobs SET state='canceled', finished=? "
+                "WHERE id=? AND state='queued'", (time.time(), job_id))
+            self.__conn.commit()
+            return c.rowcount > 0
+
+    def list_jobs(self, limit=FINISHED_JOBS_KEEP):
+        with self.__lock:
+            rows = self.__conn.execute(
+                SELECT_JOBS_QUERY + 'ORDER BY id DESC LIMIT ?',
+                (limit,)).fetchall()
+        return [job_row(r) for r in rows]
+
+
+def createJobsDB(cfg):
+    jobsdb_file = cfg.get_path('files', 'jobsdb')
+    if jobsdb_file:
+        log.info(f'Using jobsdb: {jobsdb_file}')
+        return JobsDB(jobsdb_file)
+    else:
+        log.info(f'Not persistent jobs queue')
+        return JobsDB(':memory:')
+
+
+def args_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--action', help='Action', required=True,
+        choices=['list_jobs',
+                 'cancel'])
+    parser.add_argument('-d', '--database', help='Database file')
+    parser.add_argument('-i', '--id', help='Job id', type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = args_parse()
+    db = JobsDB(args.database)
+
+    if args.action == 'list_jobs':
+        for job in db.list_jobs():
+            print(job)
+    elif args.action == 'cancel':
+        db.cancel(args.id)
+
+
+if __name__ == '__main__':
+    main()
@@ -62,6 +62,7 @@ class Patterns(object):
         self.__cuda_memory_limit = cuda_memory_limit
         self.__encoder = None
         self.__pickle_file = os.path.join(folder, 'patterns.pickle')
+        self.__pickle_mtime = None
         if not os.path.exists(self.__pickle_file):
             self.generate(True)
 
@@ -258,6 +259,7 @@ class Patterns(object):
 
     def load(self):
         try:
+            self.__pickle_mtime = os.stat(self.__pickle_file).st_mtime_ns
             data = pickle.loads(open(self.__pickle_file, 'rb').read())
             self.__files = data['files']
             self.__persons = data['persons']
@@ -265,6 +267,17 @@ class Patterns(object):
         except Exception:
             log.exception(f"Can't load patterns: {self.__pickle_file}")
 
+    def reload(self):
+        # load patterns only if they were changed by other process
+        try:
+            mtime = os.stat(self.__pickle_file).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.__pickle_mtime:
+            return False
+        self.load()
+        return True
+
     def optimize(self):
         encoder = self.__get_encoder()
 
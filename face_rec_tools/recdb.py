@@ -42,6 +42,23 @@ BEGIN
     DELETE FROM faces WHERE file_id=OLD.id;
 END;
 
+CREATE TABLE IF NOT EXISTS clusters (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "centroid" array,
+    "count" INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS cluster_faces (
+    "face_id" INTEGER PRIMARY KEY NOT NULL,
+    "cluster_id" INTEGER
+);
+
+CREATE TRIGGER IF NOT EXISTS cluster_faces_before_delete
+BEFORE DELETE ON faces
+BEGIN
+    DELETE FROM cluster_faces WHERE face_id=OLD.id;
+END;
+
 CREATE TRIGGER IF NOT EXISTS set_files_unsync
 AFTER UPDATE ON faces
 BEGIN
@@ -51,6 +68,8 @@ END;
 CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
 CREATE INDEX IF NOT EXISTS faces_file_id ON faces (file_id);
 CREATE INDEX IF NOT EXISTS faces_name ON faces (name);
+CREATE INDEX IF NOT EXISTS cluster_faces_cluster_id
+    ON cluster_faces (cluster_id);
 '''
 
 
@@ -81,7 +100,9 @@ class RecDB(object):
         if not readonly:
             self.__conn.executescript(SCHEMA)
         self.__readonly = readonly
-        atexit.register(self.commit)
+        if not readonly:
+            # server creates readonly connection for every request thread
+            atexit.register(self.commit)
         self.__all_encodings = None  # all encodings for searching by face
 
     def commit(self):
@@ -231,7 +252,7 @@ class RecDB(object):
 
         return list(fset)
 
-    def get_files(self, folder=None):
+    def get_files(self, folder=None, min_id=0):
         if folder is None:
             folder = ''
         elif len(folder) > 0 and folder[-1] == '*':
@@ -239,10 +260,17 @@ class RecDB(object):
         c = self.__conn.cursor()
         res = c.execute(
             'SELECT filename FROM files \
-             WHERE filename LIKE ?', (folder + '%',))
+             WHERE filename LIKE ? AND id>=?', (folder + '%', min_id))
 
         return [r[0] for r in res.fetchall()]
 
+    def next_file_id(self):
+        # files are reinserted on reencoding, so they get ids not less
+        # than this one
+        c = self.__conn.cursor()
+        res = c.execute('SELECT MAX(id) FROM files')
+        return (res.fetchone()[0] or 0) + 1
+
     def get_files_faces(self, where_clause, args=(), get_count=True):
         c = self.__conn.cursor()
         if get_count:
@@ -359,6 +387,9 @@ class RecDB(object):
                 self.move(old, new, commit=False)
         self.commit()
 
+    def clear_encodings_cache(self):
+        self.__all_encodings = None
+
     def get_all_encodings(self, encodings_split=1):
         if self.__all_encodings is None:
             log.debug(f'loading all encodings...')
@@ -376,6 +407,74 @@ class RecDB(object):
             log.debug(f'{len(info)} encodings was loaded')
         return self.__all_encodings
 
+    def get_clusters(self):
+        c = self.__conn.cursor()
+        res = c.execute('SELECT id, centroid, count FROM clusters')
+        ids = []
+        centroids = []
+        counts = []
+        for r in res.fetchall():
+            ids.append(r[0])
+            centroids.append(r[1])
+            counts.append(r[2])
+        return ids, centroids, counts
+
+    def add_cluster(self, centroid, count, commit=True):
+        if self.__readonly:
+            return None
+        c = self.__conn.cursor()
+        cluster_id = c.execute(
+            'INSERT INTO clusters (centroid, count) VALUES (?, ?)',
+            (centroid, count)).lastrowid
+        if commit:
+            self.__conn.commit()
+        return cluster_id
+
+    def update_cluster(self, cluster_id, centroid, count, commit=True):
+        if self.__readonly:
+            return
+        c = self.__conn.cursor()
+        c.execute('UPDATE clusters SET centroid=?, count=? WHERE id=?',
+                  (centroid, count, cluster_id))
+        if commit:
+            self.__conn.commit()
+
+    def update_clusters_counts(self, commit=True):
+        # faces are removed and reinserted with new ids on reencoding
+        if self.__readonly:
+            return
+        c = self.__conn.cursor()
+        c.execute('UPDATE clusters SET count=(SELECT COUNT(*) '
+                  'FROM cluster_faces WHERE cluster_id=clusters.id)')
+        c.execute('DELETE FROM clusters WHERE count=0')
+        if commit:
+            self.__conn.commit()
+
+    def get_faces_clusters(self):
+        c = self.__conn.cursor()
+        res = c.execute('SELECT face_id, cluster_id FROM cluster_faces')
+        return {r[0]: r[1] for r in tools.cursor_iterator(res)}
+
+    def set_faces_cluster(self, faces_clusters, commit=True):
+        # faces_clusters = [(face_id, cluster_id), ...]
+        if self.__readonly:
+            return
+        c = self.__conn.cursor()
+        c.executemany(
+            'INSERT OR REPLACE INTO cluster_faces (face_id, cluster_id) \
+             VALUES (?, ?)', faces_clusters)
+        if commit:
+            self.__conn.commit()
+
+    def clean_clusters(self, commit=True):
+        if self.__readonly:
+            return
+        c = self.__conn.cursor()
+        c.execute('DELETE FROM cluster_faces')
+        c.execute('DELETE FROM clusters')
+        if commit:
+            self.__conn.commit()
+
     def find_files_by_names(self, names, subfolder=None):
         if subfolder is None:
             subfolder = ''
@@ -407,7 +506,8 @@ def args_parse():
                  'get_files',
                  'find_files_by_names',
                  'remove_file',
-                 'update_filepaths'])
+                 'update_filepaths',
+                 'clean_clusters'])
     parser.add_argument('-c', '--config', help='Config file')
     parser.add_argument('-f', '--file', help='File or folder')
     parser.add_argument('-l', '--logfile', help='Log file')
@@ -450,6 +550,8 @@ def main():
         db.remove(args.file)
     elif args.action == 'update_filepaths':
         db.update_filepaths(args.file, args.file)
+    elif args.action == 'clean_clusters':
+        db.clean_clusters()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,9 @@
 #!/usr/bin/python3
 
-import io
 import os
-import cv2
 import sys
-import dlib
 import time
 import numpy
-import random
 import shutil
 import signal
 import argparse
@@ -17,18 +13,14 @@ import concurrent.futures
 
 sys.path.insert(0, os.path.abspath('..'))
 
-try:
-    import face_recognition
-    from face_rec_tools import faceencoder
-except ModuleNotFoundError as ex:
-    print('face_recognition not loaded, readonly mode: ' + str(ex))
-
 from face_rec_tools import log  # noqa
 from face_rec_tools import recdb  # noqa
 from face_rec_tools import tools  # noqa
 from face_rec_tools import config  # noqa
 from face_rec_tools import cachedb  # noqa
 from face_rec_tools import patterns  # noqa
+from face_rec_tools import facesaver  # noqa
+from face_rec_tools import clusterizer  # noqa
 
 
 class Recognizer(object):
@@ -36,10 +28,15 @@ class Recognizer(object):
                  patts,
                  model='hog',
                  num_jitters=1,
+                 adaptive_jitters=0,
+                 adaptive_jitters_band=0.05,
                  threshold=0.3,
                  threshold_weak=0.5,
                  threshold_clusterize=0.5,
                  threshold_equal=0.1,
+                 clusterize_method='chinese_whispers',
+                 clusterize_neighbors=50,
+                 clusterize_block_memory=256,
                  max_image_size=1000,
                  max_video_frames=180,
                  video_frames_step=1,
@@ -51,6 +48,10 @@ class Recognizer(object):
                  distance_metric='default',
                  max_workers=1,
                  video_batch_size=1,
+                 encoding_batch_size=32,
+                 media_cache_memory=512,
+                 face_save_workers=2,
+                 face_save_queue_size=64,
                  nomedia_files=(),
                  cdb=None,
                  db=None,
@@ -58,15 +59,27 @@ class Recognizer(object):
 
         self.__patterns = patts
         self.__model = model
-        self.__encoder = faceencoder.FaceEncoder(
-            encoding_model=encoding_model,
-            distance_metric=distance_metric,
-            num_jitters=num_jitters,
-            align=True)
+        self.__encoder = None
+        self.__num_jitters = int(num_jitters)
+        self.__encoding_batch_size = int(encoding_batch_size)
+        self.__distance_metric = distance_metric
+        self.__adaptive_jitters = int(adaptive_jitters)
+        self.__adaptive_jitters_band = float(adaptive_jitters_band)
+        if encoding_model not in ('small', 'large'):
+            # deepface models ignore jitters, refinement would return
+            # the same encodings
+            self.__adaptive_jitters = 0
+        # matches of last encoded batch: {id(encoding): (encoding, match)}
+        self.__batch_matches = {}
         self.__threshold = float(threshold)
         self.__threshold_weak = float(threshold_weak)
         self.__threshold_clusterize = float(threshold_clusterize)
         self.__threshold_equal = float(threshold_equal)
+        self.__clusterizer = clusterizer.Clusterizer(
+            self.__threshold_clusterize,
+            method=clusterize_method,
+            neighbors=clusterize_neighbors,
+            block_memory=clusterize_block_memory)
         self.__max_size = int(max_image_size)
         self.__max_video_frames = int(max_video_frames)
         self.__video_frames_step = int(video_frames_step)
@@ -80,7 +93,7 @@ class Recognizer(object):
         self.__db = db
 
         if status is None:
-            self.__status = tools.RECOGNIZER_STATUS_INIT
+            self.__status = dict(tools.RECOGNIZER_STATUS_INIT)
         else:
             self.__status = status
 
@@ -88,20 +101,45 @@ class Recognizer(object):
         self.__executor = concurrent.futures.ThreadPoolExecutor(
             max_workers=self.__max_workers)
 
-        self.__pattern_encodings = []
-        self.__pattern_names = []
-        self.__pattern_files = []
+        self.update_patterns()
+
+        self.__video_batch_size = int(video_batch_size)
+        self.__media_cache = tools.MediaCache(self.__max_size,
+                                              self.__max_video_frames,
+                                              self.__video_frames_step,
+                                              int(media_cache_memory))
+        self.__face_saver = facesaver.FaceSaver(self.__cdb,
+                                                self.__debug_out_image_size,
+                                                face_save_workers,
+                                                face_save_queue_size)
+
+    def update_patterns(self):
+        pattern_encodings = []
+        pattern_names = []
+        pattern_files = []
         for tp in (patterns.PATTERN_TYPE_BAD,
                    patterns.PATTERN_TYPE_GOOD,
                    patterns.PATTERN_TYPE_OTHER):
             encodings, names, files = self.__patterns.encodings(tp)
-            self.__pattern_encodings.append(numpy.array_split(
+            pattern_encodings.append(numpy.array_split(
                 numpy.array(encodings),
                 self.__max_workers))
-            self.__pattern_names.append(names)
-            self.__pattern_files.append(files)
-
-        self.__video_batch_size = int(video_batch_size)
+            pattern_names.append(names)
+            pattern_files.append(files)
+        self.__pattern_encodings = pattern_encodings
+        self.__pattern_names = pattern_names
+        self.__pattern_files = pattern_files
+
+    def __get_encoder(self):
+        if self.__encoder is None:
+            from face_rec_tools import faceencoder
+            self.__encoder = faceencoder.FaceEncoder(
+                encoding_model=self.__encoding_model,
+                distance_metric=self.__distance_metric,
+                num_jitters=self.__num_jitters,
+                align=True,
+                batch_size=self.__encoding_batch_size)
+        return self.__encoder
 
     def recognize_image(self, filename):
         log.info(f'recognize image: {filename}')
@@ -121,7 +159,7 @@ class Recognizer(object):
         image = tools.LazyImage(filename, self.__max_size)
 
         boxes = [f['box'] for f in encoded_faces]
-        encodings, landmarks, profile_angles = self.__encoder.encode(
+        encodings, landmarks, profile_angles = self.__encode(
             image.get(), boxes)
 
         for i in range(len(encoded_faces)):
@@ -147,16 +185,17 @@ class Recognizer(object):
             frame_numbers, frames = zip(
                 *all_frames[cnt: cnt + self.__video_batch_size])
 
+            import face_recognition
+
             batched_boxes = face_recognition.batch_face_locations(
                 list(frames), batch_size=len(frames))
 
-            for image, boxes, frame_num in zip(frames,
-                                               batched_boxes,
-                                               frame_numbers):
-                if self.__step_stage_face(len(boxes)):
-                    return [], None
-                encodings, landmarks, profile_angles = self.__encoder.encode(
-                    image, boxes)
+            if self.__step_stage_face(sum(map(len, batched_boxes))):
+                return [], None
+            batched_encodings = self.__encode_batch(frames, batched_boxes)
+
+            for boxes, frame_num, (encodings, landmarks, profile_angles) in \
+                    zip(batched_boxes, frame_numbers, batched_encodings):
                 encoded_faces = [
                     {'encoding': e,
                      'box': b,
@@ -181,6 +220,9 @@ class Recognizer(object):
         return dct
 
     def encode_faces(self, image):
+        import cv2
+        import face_recognition
+
         boxes = face_recognition.face_locations(image, model=self.__model)
         if not boxes:
             return []
@@ -203,7 +245,7 @@ class Recognizer(object):
         if len(filtered_boxes):
             if self.__step_stage_face(len(filtered_boxes)):
                 return []
-            encodings, landmarks, profile_angles = self.__encoder.encode(
+            encodings, landmarks, profile_angles = self.__encode(
                 image, filtered_boxes)
             res = [{'encoding': e,
                     'box': b,
@@ -219,9 +261,10 @@ class Recognizer(object):
         return res
 
     def __match_face_by_nearest(self, encoding, tp):
-        res = [r for r in self.__executor.map(self.__encoder.distance,
-                                              self.__pattern_encodings[tp],
-                                              itertools.repeat(encoding))]
+        res = [r for r in self.__executor.map(
+            self.__get_encoder().distance,
+            self.__pattern_encodings[tp],
+            itertools.repeat(encoding))]
         distances = numpy.concatenate(res)
         if len(distances) == 0:
             return 1, '', ''
@@ -230,6 +273,72 @@ class Recognizer(object):
                 self.__pattern_names[tp][i],
                 self.__pattern_files[tp][i])
 
+    def __is_borderline(self, dist):
+        for threshold in (self.__threshold, self.__threshold_weak):
+            if abs(dist - threshold) < self.__adaptive_jitters_band:
+                return True
+        return False
+
+    def __encode(self, image, boxes):
+        return self.__encode_batch((image,), (boxes,))[0]
+
+    def __encode_batch(self, images, boxes_list):
+        if not self.__adaptive_jitters:
+            return self.__get_encoder().encode_batch(images, boxes_list)
+
+        # cheap first pass, full jitters only for faces near thresholds
+        res = self.__get_encoder().encode_batch(images, boxes_list,
+                                                self.__adaptive_jitters)
+        # faces which are not refined are not matched again
+        self.__batch_matches = {}
+        refine = []
+        for i, (encodings, landmarks, profile_angles) in enumerate(res):
+            indexes = []
+            for j, e in enumerate(encodings):
+                match = self.__match_face(e)
+                if self.__is_borderline(match[0]):
+                    indexes.append(j)
+                else:
+                    self.__batch_matches[id(e)] = (e, match)
+            if indexes:
+                refine.append((i, indexes))
+
+        if len(refine) == 0:
+            return res
+
+        refined = self.__get_encoder().encode_batch(
+            [images[i] for i, indexes in refine],
+            [[boxes_list[i][j] for j in indexes] for i, indexes in refine])
+
+        count = 0
+        for (i, indexes), (encodings, landmarks, profile_angles) in \
+                zip(refine, refined):
+            for j, e in zip(indexes, encodings):
+                res[i][0][j] = e
+            count += len(indexes)
+        self.__status['faces_refined'] += count
+        log.debug(f'{count} faces refined')
+        return res
+
+    def __match_face(self, encoding):
+        dist, name, pattern = self.__match_face_by_nearest(
+            encoding, patterns.PATTERN_TYPE_GOOD)
+        if dist > 0.001:  # skip zero match
+            dist_bad, name_bad, pattern_bad = self.__match_face_by_nearest(
+                encoding, patterns.PATTERN_TYPE_BAD)
+            # match to bad only equal faces
+            if dist_bad < self.__threshold_equal and dist_bad < dist:
+                name = name_bad + '_bad'
+                dist = dist_bad
+                pattern = pattern_bad
+        return dist, name, pattern
+
+    def __match_encoded_face(self, encoding):
+        match = self.__batch_matches.pop(id(encoding), None)
+        if match is not None and match[0] is encoding:
+            return match[1]
+        return self.__match_face(encoding)
+
     def __match_faces(self, encoded_faces):
         if len(self.__pattern_encodings) == 0:
             log.warning('Empty patterns')
@@ -237,17 +346,8 @@ class Recognizer(object):
         for i in range(len(encoded_faces)):
             if self.__step_stage_face():
                 return False
-            encoding = encoded_faces[i]['encoding']
-            dist, name, pattern = self.__match_face_by_nearest(
-                encoding, patterns.PATTERN_TYPE_GOOD)
-            if dist > 0.001:  # skip zero match
-                dist_bad, name_bad, pattern_bad = self.__match_face_by_nearest(
-                    encoding, patterns.PATTERN_TYPE_BAD)
-                # match to bad only equal faces
-                if dist_bad < self.__threshold_equal and dist_bad < dist:
-                    name = name_bad + '_bad'
-                    dist = dist_bad
-                    pattern = pattern_bad
+            dist, name, pattern = self.__match_encoded_face(
+                encoded_faces[i]['encoding'])
 
             log.debug(f'matched: {name}: {dist}: {pattern}')
             if 'name' in encoded_faces[i]:
@@ -266,48 +366,82 @@ class Recognizer(object):
             encoded_faces[i]['pattern'] = pattern
         return True
 
-    def __reassign_by_count(self, labels):
-        dct = collections.defaultdict(int)
-        for old_label in labels:
-            dct[old_label] += 1
-        lst = [(count, old_label) for old_label, count in dct.items()]
-        lst.sort(reverse=True)
-        trans = {count_old_label[1]: new_label for new_label,
-                 count_old_label in enumerate(lst)}
-        return [trans[old_label] for old_label in labels]
+    def __assign_clusters(self, faces):
+        self.__db.update_clusters_counts(commit=False)
+        faces_clusters = self.__db.get_faces_clusters()
+        ids, centroids, counts = self.__db.get_clusters()
+        new_faces = [face for face in faces
+                     if face['face_id'] not in faces_clusters]
+        log.info(f'clusterize: {len(faces) - len(new_faces)} faces '
+                 f'already clustered, {len(new_faces)} new faces, '
+                 f'{len(ids)} clusters')
+
+        # assign new faces to the nearest existing clusters
+        indexes, dists = self.__clusterizer.nearest(
+            [face['encoding'] for face in new_faces], centroids)
+        sums = {}
+        added = collections.defaultdict(int)
+        leftovers = []
+        for face, index, dist in zip(new_faces, indexes, dists):
+            if dist < self.__threshold_clusterize:
+                faces_clusters[face['face_id']] = ids[index]
+                sums[index] = sums.get(index, 0) + face['encoding']
+                added[index] += 1
+            else:
+                leftovers.append(face)
+
+        for index, enc_sum in sums.items():
+            count = counts[index] + added[index]
+            centroid = (centroids[index] * counts[index] + enc_sum) / count
+            self.__db.update_cluster(ids[index], centroid, count,
+                                     commit=False)
+
+        # clusterize only faces which not assigned to existing clusters
+        labels = self.__clusterizer.clusterize(
+            [face['encoding'] for face in leftovers])
+        groups = collections.defaultdict(list)
+        for face, label in zip(leftovers, labels):
+            groups[label].append(face)
+
+        next_id = max(ids, default=0) + 1
+        for group in sorted(groups.values(), key=len, reverse=True):
+            encs = numpy.array([face['encoding'] for face in group])
+            cluster_id = self.__db.add_cluster(encs.mean(axis=0), len(group),
+                                               commit=False)
+            if cluster_id is None:
+                # readonly database, ids are valid for this run only
+                cluster_id = next_id
+            next_id = cluster_id + 1
+            for face in group:
+                faces_clusters[face['face_id']] = cluster_id
+
+        self.__db.set_faces_cluster(
+            [(face['face_id'], faces_clusters[face['face_id']])
+             for face in new_faces],
+            commit=False)
+        log.info(f'clusterize: {len(new_faces) - len(leftovers)} faces '
+                 f'assigned to existing clusters, '
+                 f'{len(groups)} new clusters')
+        return faces_clusters
 
     def __clusterize(self, files_faces, debug_out_folder=None):
         self.__start_stage(len(files_faces))
-        encs = []
-        indexes = list(range(len(files_faces)))
-        random.shuffle(indexes)
-        for i in indexes:
-            for j in range(len(files_faces[i]['faces'])):
-                encs.append(dlib.vector(
-                    files_faces[i]['faces'][j]['encoding']))
-
-        labels = dlib.chinese_whispers_clustering(
-            encs, self.__threshold_clusterize)
-
-        labels = self.__reassign_by_count(labels)
-        lnum = 0
-        for i in indexes:
+        faces_clusters = self.__assign_clusters(
+            [face for ff in files_faces for face in ff['faces']])
+
+        for ff in files_faces:
             if self.__step_stage():
                 break
-            for j in range(len(files_faces[i]['faces'])):
-                files_faces[i]['faces'][j]['name'] = \
-                    'unknown_{:05d}'.format(labels[lnum])
-                lnum += 1
+            for face in ff['faces']:
+                face['name'] = 'unknown_{:05d}'.format(
+                    faces_clusters[face['face_id']])
 
             if debug_out_folder:
-                filename = files_faces[i]['filename']
-                media = tools.load_media(filename,
-                                         self.__max_size,
-                                         self.__max_video_frames,
-                                         self.__video_frames_step)
+                filename = ff['filename']
+                media = self.__media_cache.get(filename)
                 debug_out_file_name = self.__extract_filename(filename)
                 self.__save_debug_images(
-                    files_faces[i]['faces'], media,
+                    ff['faces'], media,
                     debug_out_folder, debug_out_file_name)
         self.__end_stage()
 
@@ -418,6 +552,7 @@ class Recognizer(object):
             is_video = tools.get_low_ext(filename) in tools.VIDEO_EXTS
             if not self.__match_faces(ff['faces']):
                 continue
+            faces_to_save = []
             for face in ff['faces']:
                 if self.__step_stage_face():
                     break
@@ -433,16 +568,23 @@ class Recognizer(object):
                         f"face {face['face_id']} in file '{ff['filename']}' " +
                         f"changed '{face['oldname']}' -> '{face['name']}'")
                 if debug_out_folder and (changed or save_all_faces):
-                    media = tools.load_media(filename,
-                                             self.__max_size,
-                                             self.__max_video_frames,
-                                             self.__video_frames_step)
-                    debug_out_file_name = self.__extract_filename(filename)
+                    faces_to_save.append(face)
+            if faces_to_save:
+                # faces are checked in cachedb once per file
+                cached = self.__cached_faces(faces_to_save)
+                media = self.__media_cache.get(filename)
+                media.preload([face['frame'] for face in
+                               self.__faces_to_render(faces_to_save,
+                                                      skip_face_gen,
+                                                      cached)])
+                debug_out_file_name = self.__extract_filename(filename)
+                for face in faces_to_save:
                     self.__save_debug_images(
                         (face,), media,
                         debug_out_folder, debug_out_file_name,
                         is_video=is_video,
-                        skip_face_gen=skip_face_gen)
+                        skip_face_gen=skip_face_gen,
+                        cached=cached)
         self.__end_stage()
         log.info(f'match done: count: {cnt_all}, changed: {cnt_changed}')
 
@@ -452,10 +594,7 @@ class Recognizer(object):
                 break
             filename = ff['filename']
             log.info(f"save faces from image: {filename}")
-            media = tools.load_media(filename,
-                                     self.__max_size,
-                                     self.__max_video_frames,
-                                     self.__video_frames_step)
+            media = self.__media_cache.get(filename)
             debug_out_file_name = self.__extract_filename(filename)
             is_video = tools.get_low_ext(filename) in tools.VIDEO_EXTS
             self.__save_debug_images(
@@ -479,7 +618,8 @@ class Recognizer(object):
         return res
 
     def recognize_folder(self, folder, debug_out_folder,
-                         reencode=False, skip_face_gen=False):
+                         reencode=False, skip_face_gen=False,
+                         reencoded_from_id=None):
         if self.__init_stage('recognize_folder', locals()):
             return
         filenames = self.__get_media_from_folder(folder)
@@ -487,6 +627,15 @@ class Recognizer(object):
         if not reencode:
             filenames = list(set(filenames) - set(self.__db.get_files(folder)))
             filenames.sort()
+        else:
+            # files reencoded before preemption are skipped on resume
+            if reencoded_from_id is None:
+                reencoded_from_id = self.__db.next_file_id()
+            self.__status['resume'] = {
+                'reencoded_from_id': reencoded_from_id}
+            filenames = list(set(filenames) - set(
+                self.__db.get_files(folder, reencoded_from_id)))
+            filenames.sort()
 
         self.recognize_files(filenames, debug_out_folder, skip_face_gen)
 
@@ -531,14 +680,38 @@ class Recognizer(object):
     def __extract_filename(self, filename):
         return os.path.splitext(os.path.split(filename)[1])[0]
 
+    def __faces_to_render(self, encoded_faces, skip_face_gen, cached=None):
+        if self.__cdb is None:
+            return [] if skip_face_gen else list(encoded_faces)
+        if cached is None:
+            cached = self.__cached_faces(encoded_faces)
+        return [enc for enc in encoded_faces if enc['face_id'] not in cached]
+
+    def __cached_faces(self, encoded_faces):
+        if self.__cdb is None:
+            return set()
+        face_ids = [enc['face_id'] for enc in encoded_faces]
+        cached = set(f for f in face_ids if self.__face_saver.is_pending(f))
+        cached.update(self.__cdb.check_faces(
+            [f for f in face_ids if f not in cached]))
+        return cached
+
     def __save_debug_images(
             self, encoded_faces, media, debug_out_folder, debug_out_file_name,
-            is_video=False, skip_face_gen=False):
+            is_video=False, skip_face_gen=False, cached=None):
 
         if is_video:
             encoded_faces = tools.reduce_faces_from_video(
                 encoded_faces, self.__min_video_face_count)
 
+        if cached is None:
+            cached = self.__cached_faces(encoded_faces)
+
+        # decode only needed video frames, in frame order
+        media.preload([enc['frame'] for enc in
+                       self.__faces_to_render(encoded_faces, skip_face_gen,
+                                              cached)])
+
         for enc in encoded_faces:
             name = enc['name']
             if name == '':
@@ -554,22 +727,20 @@ class Recognizer(object):
                 f'{prefix}_{debug_out_file_name}_{left}x{top}.jpg')
 
             if self.__cdb is not None:
-                if not self.__cdb.check_face(enc['face_id']):
-                    out_stream = io.BytesIO()
-                    tools.save_face(out_stream, media.get(enc['frame']), enc,
-                                    self.__debug_out_image_size,
-                                    media.filename())
-                    self.__cdb.save_face(enc['face_id'],
-                                         out_stream.getvalue())
-                    log.debug(f"face {enc['face_id']} cached")
-                if not skip_face_gen:
-                    self.__cdb.add_to_cache(enc['face_id'], out_filename)
+                cache_filename = None if skip_face_gen else out_filename
+                if enc['face_id'] not in cached:
+                    cached.add(enc['face_id'])
+                    self.__face_saver.save_to_cache(
+                        media.get(enc['frame']), enc, media.filename(),
+                        cache_filename)
+                elif cache_filename is not None:
+                    self.__face_saver.add_to_cache(enc['face_id'],
+                                                   cache_filename)
             elif not skip_face_gen:
                 self.__make_debug_out_folder(out_folder)
-                tools.save_face(out_filename, media.get(enc['frame']), enc,
-                                self.__debug_out_image_size,
-                                media.filename())
-                log.debug(f'face saved to: {out_filename}')
+                self.__face_saver.save_to_file(
+                    out_filename, media.get(enc['frame']), enc,
+                    media.filename())
 
     def get_faces_by_face(self, filename, debug_out_folder,
                           remove_file=False):
@@ -585,7 +756,7 @@ class Recognizer(object):
         all_encodings = self.__db.get_all_encodings(self.__max_workers)
 
         res = [r for r in self.__executor.map(
-            self.__encoder.distance,
+            self.__get_encoder().distance,
             all_encodings[0],
             itertools.repeat(face['encoding']))]
         distances = numpy.concatenate(res)
@@ -604,15 +775,13 @@ class Recognizer(object):
                 break
             fname, face = info
             face['dist'] = dist
-            media = tools.load_media(fname,
-                                     self.__max_size,
-                                     self.__max_video_frames,
-                                     self.__video_frames_step)
+            media = self.__media_cache.get(fname)
             debug_out_file_name = self.__extract_filename(fname)
             self.__save_debug_images(
                 (face,), media,
                 debug_out_folder, debug_out_file_name)
             self.__step_stage_face()
+        self.__face_saver.flush()
         if remove_file:
             log.debug(f'removing temp file: {filename}')
             os.remove(filename)
@@ -638,6 +807,7 @@ class Recognizer(object):
         self.__status['current'] = 0
         self.__status['faces_count'] = 0
         self.__status['faces_per_second'] = 0
+        self.__status['faces_refined'] = 0
         self.__status['starttime'] = time.time()
 
     def __step_stage(self, step=1):
@@ -652,6 +822,7 @@ class Recognizer(object):
         return self.__status['stop']
 
     def __end_stage(self):
+        self.__face_saver.flush()
         if self.__status.get('save', True):
             log.info(f'Commit transaction')
             if self.__db is not None:
@@ -664,6 +835,7 @@ class Recognizer(object):
                 self.__db.rollback()
             if self.__cdb is not None:
                 self.__cdb.rollback()
+        self.__media_cache.clear()
         self.__status['stop'] = False
         self.__status['endtime'] = time.time()
         log.info(f'end stage: {self.__status}')
@@ -673,11 +845,20 @@ def createRecognizer(patt, cfg, cdb=None, db=None, status=None):
     return Recognizer(patt,
                       model=cfg['recognition']['model'],
                       num_jitters=cfg['recognition']['num_jitters'],
+                      adaptive_jitters=cfg['recognition']['adaptive_jitters'],
+                      adaptive_jitters_band=cfg['recognition'][
+                          'adaptive_jitters_band'],
                       threshold=cfg['recognition']['threshold'],
                       threshold_weak=cfg['recognition']['threshold_weak'],
                       threshold_clusterize=cfg['recognition'][
                           'threshold_clusterize'],
                       threshold_equal=cfg['recognition']['threshold_equal'],
+                      clusterize_method=cfg['recognition'][
+                          'clusterize_method'],
+                      clusterize_neighbors=cfg['recognition'][
+                          'clusterize_neighbors'],
+                      clusterize_block_memory=cfg['processing'][
+                          'clusterize_block_memory'],
                       max_image_size=cfg['processing']['max_image_size'],
                       max_video_frames=cfg['processing']['max_video_frames'],
                       video_frames_step=cfg['processing']['video_frames_step'],
@@ -692,6 +873,14 @@ def createRecognizer(patt, cfg, cdb=None, db=None, status=None):
                       distance_metric=cfg['recognition']['distance_metric'],
                       max_workers=cfg['processing']['max_workers'],
                       video_batch_size=cfg['processing']['video_batch_size'],
+                      encoding_batch_size=cfg['processing'][
+                          'encoding_batch_size'],
+                      media_cache_memory=cfg['processing'][
+                          'media_cache_memory'],
+                      face_save_workers=cfg['processing'][
+                          'face_save_workers'],
+                      face_save_queue_size=cfg['processing'][
+                          'face_save_queue_size'],
                       nomedia_files=cfg['files']['nomedia_files'].split(':'),
                       cdb=cdb,
                       db=db,
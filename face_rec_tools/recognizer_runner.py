@@ -3,6 +3,7 @@
 import os
 import sys
 import time
+import argparse
 import multiprocessing
 
 sys.path.insert(0, os.path.abspath('..'))
@@ -11,14 +12,82 @@ from face_rec_tools import log  # noqa
 from face_rec_tools import tools  # noqa
 
 
+class RecognizerStatus(object):
+    # counters are updated for every face, so they are kept in shared
+    # memory without locks (only recognizer process changes them),
+    # rarely changed keys are kept in manager dict
+    COUNTERS = (('count', int),
+                ('current', int),
+                ('faces_count', int),
+                ('faces_per_second', float),
+                ('faces_refined', int),
+                ('starttime', float),
+                ('stop', bool))
+
+    def __init__(self, manager):
+        self.__counters = {key: (i, tp)
+                           for i, (key, tp) in enumerate(self.COUNTERS)}
+        self.__values = multiprocessing.RawArray('d', len(self.COUNTERS))
+        self.__dict = manager.dict()
+        for key, value in tools.RECOGNIZER_STATUS_INIT.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.__counters:
+            i, tp = self.__counters[key]
+            return tp(self.__values[i])
+        return self.__dict[key]
+
+    def __setitem__(self, key, value):
+        if key in self.__counters:
+            self.__values[self.__counters[key][0]] = value
+        else:
+            self.__dict[key] = value
+
+    def __contains__(self, key):
+        return key in self.__counters or key in self.__dict
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def get(self, key, default=None):
+        if key in self.__counters:
+            return self[key]
+        return self.__dict.get(key, default)
+
+    def copy(self):
+        status = dict(self.__dict)
+        for key in self.__counters:
+            status[key] = self[key]
+        return status
+
+
 class RecognizerRunner(multiprocessing.Process):
-    def __init__(self, config, method, *args):
-        multiprocessing.Process.__init__(self)
+    # long-lived worker process: models, patterns and encodings are kept
+    # loaded between jobs, process exits after job failure and is
+    # restarted by server
+    CUDA_METHODS = ('recognize_folder', 'match', 'get_faces_by_face')
+
+    def __init__(self, config):
+        multiprocessing.Process.__init__(self, daemon=True)
         self.__config = config
-        self.__method = method
-        self.__args = args
+        self.__jobs = multiprocessing.Queue()
         self.__manager = multiprocessing.Manager()
-        self.__status = self.__manager.dict(tools.RECOGNIZER_STATUS_INIT)
+        self.__status = RecognizerStatus(self.__manager)
+
+    def start_job(self, method, *args, **kwargs):
+        # job state is set before job is taken by worker,
+        # so state of previous job is not reported anymore
+        for key, value in tools.RECOGNIZER_STATUS_INIT.items():
+            self.__status[key] = value
+        self.__status['state'] = method
+        self.__status['save'] = True
+        self.__status['resume'] = None
+        self.__jobs.put((method, args, kwargs))
+
+    def shutdown(self):
+        self.__jobs.put(None)
+        self.join()
 
     def run(self):
         os.nice(10)
@@ -37,41 +106,59 @@ class RecognizerRunner(multiprocessing.Process):
             db = recdb.RecDB(cfg.get_path('files', 'db'))
             cdb = cachedb.createCacheDB(cfg)
             cuda_memory_limit = int(cfg['processing']['cuda_memory_limit'])
+            cuda_initialized = False
 
-            log.info(f'Run in process: {self.__method}{self.__args}')
-
-            if self.__method == 'recognize_folder':
-                tools.cuda_init(cuda_memory_limit)
-                recognizer = recognizer.createRecognizer(
-                    patterns, cfg, cdb, db, self.__status)
-                recognizer.recognize_folder(*self.__args)
-            elif self.__method == 'match':
-                tools.cuda_init(cuda_memory_limit)
-                recognizer = recognizer.createRecognizer(
-                    patterns, cfg, cdb, db, self.__status)
-                recognizer.match(*self.__args)
-            elif self.__method == 'clusterize':
-                recognizer = recognizer.createRecognizer(
-                    patterns, cfg, cdb, db, self.__status)
-                recognizer.clusterize(*self.__args)
-            elif self.__method == 'save_faces':
-                recognizer = recognizer.createRecognizer(
-                    patterns, cfg, cdb, db, self.__status)
-                recognizer.save_faces(*self.__args)
-            elif self.__method == 'get_faces_by_face':
-                tools.cuda_init(cuda_memory_limit)
-                recognizer = recognizer.createRecognizer(
-                    patterns, cfg, cdb, db, self.__status)
-                recognizer.get_faces_by_face(*self.__args)
-            log.info(f'Process done: {self.__method}')
-            self.__status['state'] = 'done'
+            recognizer = recognizer.createRecognizer(
+                patterns, cfg, cdb, db, self.__status)
         except Exception as ex:
             log.exception(ex)
             self.__status['state'] = 'error'
             self.__status['error'] = str(ex)
+            return
+
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            method, args, kwargs = job
+            try:
+                if patterns.reload():
+                    log.info('Patterns changed, reload')
+                    recognizer.update_patterns()
+
+                if method in self.CUDA_METHODS and not cuda_initialized:
+                    tools.cuda_init(cuda_memory_limit)
+                    cuda_initialized = True
+
+                log.info(f'Run in process: {method}{args}{kwargs}')
+
+                if method == 'recognize_folder':
+                    recognizer.recognize_folder(*args, **kwargs)
+                elif method == 'match':
+                    recognizer.match(*args, **kwargs)
+                elif method == 'clusterize':
+                    recognizer.clusterize(*args, **kwargs)
+                elif method == 'save_faces':
+                    recognizer.save_faces(*args, **kwargs)
+                elif method == 'get_faces_by_face':
+                    recognizer.get_faces_by_face(*args, **kwargs)
+                if method != 'get_faces_by_face':
+                    # faces and names in database can be changed
+                    db.clear_encodings_cache()
+                if cdb is not None and method != 'get_faces_by_face':
+                    # orphan faces appear only after files reencoding
+                    cdb.gc(cfg.get_path('files', 'db')
+                           if method == 'recognize_folder' else None)
+                log.info(f'Process done: {method}')
+                self.__status['state'] = 'done'
+            except Exception as ex:
+                log.exception(ex)
+                self.__status['state'] = 'error'
+                self.__status['error'] = str(ex)
+                break
 
     def status(self):
-        status = dict(self.__status)
+        status = self.__status.copy()
         if status['current'] > 0:
             elap_time = time.time() - status['starttime']
             est_time = \
@@ -88,3 +175,47 @@ class RecognizerRunner(multiprocessing.Process):
         log.info(f'Runner stop called ({save})')
         self.__status['stop'] = True
         self.__status['save'] = save
+
+
+def __speed_test(status, count):
+    status['starttime'] = time.time()
+    for i in range(count):
+        # the same as Recognizer.__step_stage_face
+        status['faces_count'] += 1
+        status['faces_per_second'] = round(
+            status['faces_count'] / (time.time() - status['starttime']), 2)
+        if status['stop']:
+            break
+
+
+def speed_test(count):
+    manager = multiprocessing.Manager()
+    for name, status in (
+            ('manager', manager.dict(tools.RECOGNIZER_STATUS_INIT)),
+            ('shared', RecognizerStatus(manager))):
+        start = time.time()
+        __speed_test(status, count)
+        elapsed = time.time() - start
+        print(f'{name}: {count} faces, {elapsed:.3f} sec, '
+              f'{elapsed / count * 1000000:.1f} sec per million faces')
+
+
+def args_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--action', help='Action', required=True,
+        choices=['speed_test'])
+    parser.add_argument('-c', '--count', help='Faces count',
+                        type=int, default=100000)
+    return parser.parse_args()
+
+
+def main():
+    args = args_parse()
+
+    if args.action == 'speed_test':
+        speed_test(args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,23 @@
 #!/usr/bin/python3
 
+import io
 import os
 import re
 import cgi
 import sys
 import json
+import time
 import shutil
 import urllib
+import hashlib
 import tempfile
 import argparse
+import mimetypes
+import threading
 import http.server
+import email.utils
 import collections
+import socketserver
 
 sys.path.insert(0, os.path.abspath('..'))
 
@@ -18,30 +25,57 @@ from face_rec_tools import log  # noqa
 from face_rec_tools import recdb  # noqa
 from face_rec_tools import tools  # noqa
 from face_rec_tools import config  # noqa
+from face_rec_tools import jobsdb  # noqa
 from face_rec_tools import cachedb  # noqa
 from face_rec_tools import patterns  # noqa
 from face_rec_tools import recognizer_runner  # noqa
 
+PREVIEW_SIZE = 1024
+PREVIEW_MIN_SIZE = 64
+
+# sprite is rendered in memory, so its dimensions are limited
+SPRITE_MAX_FACES = 1000
+SPRITE_MAX_COLUMNS = 50
+SPRITE_MIN_SIZE = 16
+SPRITE_MAX_SIZE = 400
+
+# status stream is closed and reopened by browser periodically,
+# so server threads are not occupied by forgotten tabs forever
+STATUS_STREAM_TIME = 300
+STATUS_KEEPALIVE_TIME = 15
+
+# jobs with higher priority preempt running jobs with lower priority
+JOB_PRIORITIES = {
+    'get_faces_by_face': 20,
+    'clusterize': 10,
+    'save_faces': 10,
+    'match': 0,
+    'recognize_folder': 0,
+}
+
 
 class FaceRecHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive connections, every response must have Content-Length
+    protocol_version = 'HTTP/1.1'
+    # close idle keep-alive connections to free server threads
+    timeout = 30
 
-    def __ok_response(self, result):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+    def __response(self, code, cont, data):
+        self.send_response(code)
+        self.send_header('Content-type', cont)
+        self.send_header('Content-Length', str(len(data)))
         self.end_headers()
-        self.wfile.write(bytearray(json.dumps(result), 'utf-8'))
+        self.wfile.write(data)
+
+    def __ok_response(self, result):
+        self.__response(200, 'application/json',
+                        json.dumps(result).encode('utf-8'))
 
     def __text_response(self, result):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(bytearray(result, 'utf-8'))
+        self.__response(200, 'text/plain', result.encode('utf-8'))
 
     def __bad_request_response(self, err):
-        self.send_response(400)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(bytearray(err, 'utf-8'))
+        self.__response(400, 'text/plain', err.encode('utf-8'))
 
     def __not_found_response(self):
         self.send_error(404, 'File Not Found: %s' % self.path)
@@ -49,6 +83,88 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
     def __server_error_response(self, err):
         self.send_error(500, 'Internal Server Error: %s' % err)
 
+    def __variant(self, cont, params):
+        if cont != 'image/jpeg':
+            return ''
+        if 'thumbnail' in params:
+            return params['thumbnail'][0]
+        return 'overlay'
+
+    def __send_validators(self, etag, mtime):
+        self.send_header('ETag', etag)
+        if mtime is not None:
+            self.send_header('Last-Modified',
+                             email.utils.formatdate(mtime, usegmt=True))
+        # names in cache are reused, browser must revalidate images
+        self.send_header('Cache-Control', 'no-cache')
+
+    def __not_modified(self, etag, mtime=None):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            res = etag in tags or '*' in tags
+        else:
+            res = False
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since is not None and mtime is not None:
+                try:
+                    res = int(mtime) <= email.utils.parsedate_to_datetime(
+                        if_modified_since).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        if res:
+            self.send_response(304)
+            self.__send_validators(etag, mtime)
+            self.end_headers()
+        return res
+
+    def __range(self, etag, size):
+        rng = self.headers.get('Range')
+        if rng is None or self.headers.get('If-Range', etag) != etag:
+            return None
+        # multiple ranges are not supported, full content sent
+        m = re.match(r'^bytes=(\d*)-(\d*)$', rng.strip())
+        if m is None:
+            return None
+        first, last = m.groups()
+        if first == '':
+            if last == '' or int(last) == 0:
+                return False
+            return max(0, size - int(last)), size - 1
+        start = int(first)
+        end = size - 1 if last == '' else min(int(last), size - 1)
+        if start > end:
+            return False
+        return start, end
+
+    def __send_headers(self, cont, size, etag, mtime=None):
+        rng = self.__range(etag, size)
+        if rng is False:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        if rng is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = rng
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-type', cont)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.__send_validators(etag, mtime)
+        self.end_headers()
+        return start, end
+
+    def __send_data(self, data, cont, etag, mtime=None):
+        rng = self.__send_headers(cont, len(data), etag, mtime)
+        if rng is not None:
+            start, end = rng
+            self.wfile.write(memoryview(data)[start:end + 1])
+
     def __file_request(self, path, params):
         if path[0] == '/':
             path = path[1:]
@@ -57,10 +173,18 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
 
         if path.startswith('cache/'):
             fname = os.path.join(self.server.face_cache_path(), path[6:])
-            if self.server.cdb() is not None:
-                data = self.server.cdb().get_from_cache(fname)
-                if data is not None:
-                    self.__send_blob(data, 'image/jpeg', params)
+            cdb = self.server.cdb()
+            if cdb is not None:
+                face_id = cdb.get_cache_face_id(fname)
+                if face_id is not None:
+                    etag = '"{}-{}-{}"'.format(
+                        face_id, cdb.generation(),
+                        self.__variant('image/jpeg', params))
+                    if self.__not_modified(etag):
+                        return
+                    data = cdb.get_from_cache(fname)
+                if face_id is not None and data is not None:
+                    self.__send_blob(data, 'image/jpeg', params, etag)
                 else:
                     self.__not_found_response()
                     log.debug(f'File in cache not found: {fname}')
@@ -72,7 +196,14 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
 
         self.__send_file(fname, params)
 
-    def __send_file(self, fname, params={}):
+    def __stream_file(self, f, cont, etag, st):
+        rng = self.__send_headers(cont, st.st_size, etag, st.st_mtime)
+        if rng is not None and st.st_size > 0:
+            start, end = rng
+            self.wfile.flush()
+            self.connection.sendfile(f, start, end - start + 1)
+
+    def __send_file(self, fname, params={}, raw=False):
         try:
             ext = tools.get_low_ext(fname)
             cont = ''
@@ -87,36 +218,52 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
             elif ext == '.jpg':
                 cont = 'image/jpeg'
             else:
-                cont = 'text/none'
+                cont = mimetypes.guess_type(fname)[0] or \
+                    'application/octet-stream'
+            st = os.stat(fname)
+            variant = '' if raw else self.__variant(cont, params)
+            etag = '"{:x}-{:x}-{}"'.format(st.st_mtime_ns, st.st_size,
+                                           variant)
+            if self.__not_modified(etag, st.st_mtime):
+                return
             with open(fname, 'rb') as f:
-                self.__send_blob(f.read(), cont, params)
+                # face images are small and processed in memory,
+                # other files streamed without reading to memory
+                if raw or cont != 'image/jpeg':
+                    self.__stream_file(f, cont, etag, st)
+                else:
+                    self.__send_blob(f.read(), cont, params, etag,
+                                     st.st_mtime)
         except IOError as ex:
             self.__not_found_response()
             log.exception(ex)
 
-    def __send_blob(self, data, cont, params):
-        if 'thumbnail' in params:
-            if params['thumbnail'][0] == 'on':
-                data = tools.load_face_thumbnail(data)
-            elif params['thumbnail'][0] == 'prefer':
-                th_data = tools.load_face_thumbnail(data)
-                if th_data:
-                    data = th_data
-        self.send_response(200)
-        self.send_header('Content-type', cont)
-        self.end_headers()
-        self.wfile.write(bytearray(data))
+    def __send_blob(self, data, cont, params, etag, mtime=None):
+        if cont == 'image/jpeg':
+            if 'thumbnail' in params:
+                # old face files keep image without landmarks in thumbnail
+                if params['thumbnail'][0] in ('on', 'prefer'):
+                    th_data = tools.load_face_thumbnail(data)
+                    if th_data:
+                        data = th_data
+            else:
+                data = self.server.face_overlay(data)
+        self.__send_data(data, cont, etag, mtime)
+
+    def __raw_data(self):
+        datalen = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(datalen)
 
     def __data(self):
-        datalen = int(self.headers['Content-Length'])
-        data_raw = self.rfile.read(datalen)
-        data = data_raw.decode('utf-8')
+        data = self.__raw_data().decode('utf-8')
         return urllib.parse.parse_qs(data)
 
     def __form_data(self):
+        # read exactly request body, connection is reused for next requests
         ctype, pdict = cgi.parse_header(self.headers['Content-Type'])
         pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
-        form = cgi.parse_multipart(self.rfile, pdict)
+        pdict['CONTENT-LENGTH'] = self.headers['Content-Length']
+        form = cgi.parse_multipart(io.BytesIO(self.__raw_data()), pdict)
         return form
 
     def __path_params(self):
@@ -128,8 +275,27 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
 
     def __list_cache(self, params):
         cache_path = self.server.face_cache_path()
-        if self.server.cdb() is not None:
-            image_files = self.server.cdb().list_cache()
+        cdb = self.server.cdb()
+        sort_by_date = 'sort' in params and params['sort'][0] == 'date'
+
+        if 'names' in params:
+            self.__ok_response(self.__list_cache_names(cdb, cache_path))
+            return
+        if 'name' in params:
+            self.__ok_response(self.__list_cache_page(
+                cdb, cache_path, params['name'][0],
+                int(params.get('offset', ('0',))[0]),
+                int(params.get('limit', ('100',))[0]),
+                sort_by_date))
+            return
+        if 'since' in params:
+            self.__ok_response(self.__list_cache_since(
+                cdb, cache_path, int(params['since'][0]),
+                int(params.get('generation', ('0',))[0])))
+            return
+
+        if cdb is not None:
+            image_files = cdb.list_cache()
         else:
             image_files = tools.list_files(cache_path, tools.IMAGE_EXTS)
 
@@ -138,8 +304,8 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
             name = image_file.split(os.path.sep)[-2]
             result[name].append(os.path.relpath(image_file, cache_path))
 
-        if 'sort' in params and params['sort'][0] == 'date':
-            def key(s): return re.sub('_\d\d\d_', '_', s)
+        if sort_by_date:
+            key = cachedb.cache_sort_key
         else:
             key = None
         res_list = [(k, sorted(r, key=key)) for k, r in result.items()]
@@ -147,6 +313,90 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
 
         self.__ok_response(res_list)
 
+    def __list_cache_files(self, cache_path):
+        result = collections.defaultdict(lambda: [])
+        for image_file in tools.list_files(cache_path, tools.IMAGE_EXTS):
+            result[cachedb.cache_name(image_file)].append(image_file)
+        return result
+
+    def __list_cache_names(self, cdb, cache_path):
+        if cdb is not None:
+            generation = cdb.generation()
+            last_id = cdb.last_cache_id()
+            names = cdb.list_cache_names()
+        else:
+            generation = 0
+            last_id = 0
+            names = sorted((name, len(files), min(files)) for name, files
+                           in self.__list_cache_files(cache_path).items())
+        return {'generation': generation,
+                'last_id': last_id,
+                'names': [(name, count, os.path.relpath(first, cache_path))
+                          for name, count, first in names]}
+
+    def __list_cache_page(self, cdb, cache_path, name, offset, limit,
+                          sort_by_date):
+        if cdb is not None:
+            files = cdb.list_cache_page(name, offset, limit, sort_by_date)
+        else:
+            key = cachedb.cache_sort_key if sort_by_date else None
+            files = sorted(self.__list_cache_files(cache_path)[name],
+                           key=key)[offset:offset + limit]
+        return {'files': [os.path.relpath(f, cache_path) for f in files]}
+
+    def __sprite_params(self, params):
+        cache_path = self.server.face_cache_path()
+        cdb = self.server.cdb()
+        name = params['name'][0]
+        offset = max(0, int(params.get('offset', ('0',))[0]))
+        limit = max(0, min(int(params.get('limit', ('100',))[0]),
+                           SPRITE_MAX_FACES))
+        sort_by_date = params.get('sort', ('',))[0] == 'date'
+        overlay = 'thumbnail' not in params
+        size = max(SPRITE_MIN_SIZE, min(int(params.get('size', ('100',))[0]),
+                                        SPRITE_MAX_SIZE))
+        columns = max(1, min(int(params.get('columns', ('20',))[0]),
+                             SPRITE_MAX_COLUMNS))
+
+        def list_files():
+            return self.__list_cache_page(cdb, cache_path, name, offset,
+                                          limit, sort_by_date)['files']
+
+        return ((name, offset, limit, sort_by_date, overlay, size, columns),
+                list_files, overlay, size, columns)
+
+    def __get_sprite_index(self, params):
+        sprite = self.server.face_sprite(*self.__sprite_params(params))
+        self.__ok_response({'tiles': sprite['tiles']})
+
+    def __get_sprite(self, params):
+        key, list_files, overlay, size, columns = self.__sprite_params(params)
+        # sprite is not rendered for revalidation
+        if self.__not_modified(self.server.face_sprite_etag(key, list_files)):
+            return
+        sprite = self.server.face_sprite(key, list_files, overlay, size,
+                                         columns)
+        self.__send_data(sprite['data'], 'image/jpeg', sprite['etag'])
+
+    def __list_cache_since(self, cdb, cache_path, last_id, generation):
+        if cdb is None:
+            # files changes are not tracked without cachedb
+            return {'generation': 0, 'last_id': 0, 'reset': False,
+                    'files': []}
+        current = cdb.generation()
+        if current != generation:
+            return {'generation': current, 'last_id': 0, 'reset': True,
+                    'files': []}
+        rows = cdb.list_cache_since(last_id)
+        if rows:
+            last_id = rows[-1][0]
+        return {'generation': current,
+                'last_id': last_id,
+                'reset': False,
+                'files': [(cachedb.cache_name(f),
+                           os.path.relpath(f, cache_path))
+                          for i, f in rows]}
+
     def __clean_cache(self):
         self.server.clean_cache()
         self.__ok_response('')
@@ -175,9 +425,11 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
         descr = self.__get_face_file_description(path)
         if descr is None:
             self.__not_found_response()
+            return
         src_filename = descr.get('src', None)
         if src_filename is None:
             self.__not_found_response()
+            return
         if 'type' in params and params['type'][0] == 'info':
             ext = tools.get_low_ext(src_filename)
             tp = ''
@@ -191,7 +443,25 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
                 'names': self.server.db().get_names(src_filename)
             })
         else:
-            self.__send_file(src_filename)
+            self.__send_file(src_filename, raw=True)
+
+    def __get_face_preview(self, params):
+        path = params['path'][0]
+        descr = self.__get_face_file_description(path)
+        if descr is None or descr.get('src', None) is None:
+            self.__not_found_response()
+            return
+        size = int(params.get('size', [PREVIEW_SIZE])[0])
+        try:
+            fname, etag = self.server.face_preview(descr, size)
+            if self.__not_modified(etag):
+                return
+            with open(fname, 'rb') as f:
+                self.__stream_file(f, 'image/jpeg', etag,
+                                   os.fstat(f.fileno()))
+        except IOError as ex:
+            self.__not_found_response()
+            log.exception(ex)
 
     def __get_face_pattern(self, params):
         path = params['path'][0]
@@ -222,34 +492,64 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
     def __get_status(self):
         self.__ok_response(self.server.status())
 
+    def __get_jobs(self):
+        self.__ok_response(self.server.jobs())
+
+    def __cancel_job_request(self, params):
+        if self.server.cancel_job(int(params['id'][0])):
+            self.__ok_response('')
+        else:
+            self.__bad_request_response('Job is not queued')
+
+    def __status_events(self):
+        if not self.server.status_stream_acquire():
+            # browser falls back to get_status polling
+            self.__response(503, 'text/plain', b'Too many status streams')
+            return
+        try:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            # first event is full status, next ones are changed keys only,
+            # removed keys are sent as null
+            sent = {}
+            version = None
+            endtime = time.time() + STATUS_STREAM_TIME
+            while time.time() < endtime:
+                version, status = self.server.wait_status(
+                    version, STATUS_KEEPALIVE_TIME)
+                delta = {k: v for k, v in status.items()
+                         if k not in sent or sent[k] != v}
+                delta.update({k: None for k in sent if k not in status})
+                sent = status
+                if delta:
+                    data = 'data: ' + json.dumps(delta) + '\n\n'
+                else:
+                    data = ': keepalive\n\n'
+                self.wfile.write(data.encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            log.debug('status stream closed')
+        finally:
+            self.server.status_stream_release()
+
     def __add_to_pattern_request(self, params, data):
-        cache_path = self.server.face_cache_path()
         files = data['files'][0].split('|')
-        filenames = [os.path.join(cache_path, f) for f in files]
-        if self.server.cdb() is not None:
-            for fn in filenames:
-                data = self.server.cdb().get_from_cache(fn)
-                if data is None:
-                    raise Exception(f'No data for file {fn}')
-                self.server.patterns().add_file_data(params['name'][0],
-                                                     fn, data,
-                                                     params['bad'][0] == '1')
-                self.server.cdb().remove_from_cache(fn)
-            self.server.cdb().commit()
-        else:
-            self.server.patterns().add_files(params['name'][0],
-                                             filenames, True, True,
-                                             params['bad'][0] == '1')
-        self.server.update_persons(params['name'][0])
+        self.server.add_to_pattern(params['name'][0], files,
+                                   params['bad'][0] == '1')
         self.__ok_response('')
 
     def __recognize_folder_request(self, params):
         reencode = params.get('reencode', ('',))[0] == '1'
         skip_face_gen = params.get('skip_face_gen', ('',))[0] == '1'
 
-        self.server.recognize_folder(
+        job_id = self.server.recognize_folder(
             os.path.expanduser(params['path'][0]), reencode, skip_face_gen)
-        self.__ok_response('')
+        self.__ok_response({'job_id': job_id})
 
     def __params_to_filter(self, params):
         fltr = {}
@@ -262,28 +562,28 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
 
     def __generate_faces_request(self, params):
         fltr = self.__params_to_filter(params)
-        self.server.save_faces(fltr)
-        self.__ok_response('')
+        job_id = self.server.save_faces(fltr)
+        self.__ok_response({'job_id': job_id})
 
     def __match_request(self, params):
         save_faces = params.get('save_faces', ('',))[0] == '1'
         skip_face_gen = params.get('skip_face_gen', ('',))[0] == '1'
 
         fltr = self.__params_to_filter(params)
-        self.server.match(fltr, save_faces, skip_face_gen)
-        self.__ok_response('')
+        job_id = self.server.match(fltr, save_faces, skip_face_gen)
+        self.__ok_response({'job_id': job_id})
 
     def __clusterize_request(self, params):
         fltr = self.__params_to_filter(params)
-        self.server.clusterize(fltr)
-        self.__ok_response('')
+        job_id = self.server.clusterize(fltr)
+        self.__ok_response({'job_id': job_id})
 
     def __get_faces_by_face_request(self, params, data):
         tf = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
         tf.write(data['file'][0])
         tf.close()
-        self.server.get_faces_by_face(tf.name)
-        self.__ok_response('')
+        job_id = self.server.get_faces_by_face(tf.name)
+        self.__ok_response({'job_id': job_id})
 
     def __stop_request(self, params):
         save = params.get('save', ('',))[0] == '1'
@@ -298,6 +598,14 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
                 self.__list_cache(params)
                 return
 
+            if path == '/get_sprite_index':
+                self.__get_sprite_index(params)
+                return
+
+            if path == '/get_sprite':
+                self.__get_sprite(params)
+                return
+
             if path == '/get_names':
                 self.__get_names()
                 return
@@ -314,10 +622,22 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
                 self.__get_status()
                 return
 
+            if path == '/status_events':
+                self.__status_events()
+                return
+
+            if path == '/get_jobs':
+                self.__get_jobs()
+                return
+
             if path == '/get_face_src':
                 self.__get_face_src(params)
                 return
 
+            if path == '/get_face_preview':
+                self.__get_face_preview(params)
+                return
+
             if path == '/get_face_pattern':
                 self.__get_face_pattern(params)
                 return
@@ -345,6 +665,10 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
         log.debug('do_POST: ' + self.path)
         try:
             path, params = self.__path_params()
+            if path not in ('/add_to_pattern', '/get_faces_by_face'):
+                # unused body is skipped, next request on keep-alive
+                # connection starts after it
+                self.__raw_data()
 
             if path == '/add_to_pattern':
                 self.__add_to_pattern_request(params, self.__data())
@@ -374,55 +698,176 @@ class FaceRecHandler(http.server.BaseHTTPRequestHandler):
                 self.__stop_request(params)
                 return
 
+            if path == '/cancel_job':
+                self.__cancel_job_request(params)
+                return
+
             if path == '/clean_cache':
                 self.__clean_cache()
                 return
 
+            log.warning('Wrong path: ' + path)
+            self.__not_found_response()
         except Exception as ex:
             self.__server_error_response(str(ex))
             log.exception(ex)
 
 
-class FaceRecServer(http.server.HTTPServer):
+class FaceRecServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
     def __init__(self, cfg):
         self.__status = {'state': ''}
         self.__recognizer = None
+        self.__recognizer_busy = False
+        self.__job = None
+        self.__job_stopped = False
+        self.__job_preempted = False
+        self.__job_starting = False
         self.__cfg = cfg
 
+        # recognizer and jobs state
+        self.__lock = threading.RLock()
+        # patterns can be generated for long time, so they have own lock
+        self.__patterns_lock = threading.RLock()
+        self.__overlay_lock = threading.Lock()
+
+        # every connection is processed by own thread, idle keep-alive
+        # connections do not block other requests
+        self.__local = threading.local()
+
         self.__patterns = patterns.createPatterns(cfg)
         self.__patterns.load()
         self.__load_patterns_persons()
 
-        self.__db = recdb.RecDB(cfg.get_path('files', 'db'))
-        self.__cdb = cachedb.createCacheDB(cfg)
+        self.__db_file = cfg.get_path('files', 'db')
+        # create database schema, requests threads use read-only connections
+        recdb.RecDB(self.__db_file).commit()
+        self.__cdb = cachedb.createCacheDB(
+            cfg, readers=cfg['server']['cachedb_readers'])
+        self.__jobs = jobsdb.createJobsDB(cfg)
 
         port = int(cfg['server']['port'])
 
         self.__web_path = cfg.get_data_path('server', 'web_path')
 
         self.__face_cache_path = cfg['server']['face_cache_path']
+
+        self.__overlay_cache = collections.OrderedDict()
+        self.__overlay_cache_size = int(cfg['server']['overlay_cache_size'])
+
+        self.__sprite_lock = threading.Lock()
+        self.__sprite_cache = collections.OrderedDict()
+        self.__sprite_cache_size = int(cfg['server']['sprite_cache_size'])
+
+        # status is read from recognizer process by one thread only,
+        # requests get the last snapshot
+        self.__status_cond = threading.Condition()
+        self.__status_version = 0
+        self.__status_wakeup = threading.Event()
+        self.__status_interval = float(cfg['server']['status_interval'])
+        self.__status_streams = threading.BoundedSemaphore(
+            int(cfg['server']['status_streams']))
+        threading.Thread(target=self.__status_loop, daemon=True).start()
+
+        self.__max_image_size = int(cfg['processing']['max_image_size'])
+        self.__preview_cache = tools.PreviewCache(
+            cfg['server']['preview_cache_path'],
+            int(cfg['server']['preview_cache_size']))
+
         super().__init__(('', port), FaceRecHandler)
 
     def __start_recognizer(self, method, *args):
-        self.status()
-        if self.__recognizer is not None:
-            log.warning('Trying to create second recognizer')
-            raise Exception('Recognizer already started')
+        # jobs are started by status thread only
+        job_id = self.__jobs.add(method, args, JOB_PRIORITIES[method])
+        log.info(f'Job {job_id} queued: {method}{args}')
+        with self.__lock:
+            idle = not self.__recognizer_busy and not self.__job_starting
+        if idle:
+            # state of previous job is not reported until job is started
+            status = dict(tools.RECOGNIZER_STATUS_INIT)
+            status.update({'state': method, 'job_id': job_id,
+                           'queued': 1, 'estimation': '', 'elapsed': ''})
+            self.__set_status(status)
+        self.__status_wakeup.set()
+        return job_id
+
+    def __next_job(self):
+        job = self.__jobs.next()
+        if job is None:
+            return None
+        log.info(f'Job {job["id"]} started: {job["method"]}')
+        self.__jobs.start(job['id'])
+        # job which preempted other one keeps its faces in cache
+        job['preempting'] = self.__job_preempted
+        self.__job = job
+        self.__job_stopped = False
+        self.__job_preempted = False
+        self.__job_starting = True
+        return job
+
+    def __prepare_job(self, job):
+        method, args = job['method'], job['args']
+        skip_face_gen = False
+        if method in ('recognize_folder', 'match'):
+            self.__generate_patterns()
+            skip_face_gen = args[3]
+        # resumed job keeps faces of jobs which preempted it
+        if not skip_face_gen and not job['preempted'] and \
+                not job['preempting']:
+            self.clean_cache()
 
-        self.__recognizer = recognizer_runner.RecognizerRunner(
-            self.__cfg.filename(), method, *args)
-        self.__recognizer.start()
+    def __run_job(self, job):
+        self.__job_starting = False
+        if self.__job_stopped:
+            self.__jobs.finish(job['id'], 'stopped')
+            return False
+        if self.__recognizer is None:
+            self.__recognizer = recognizer_runner.RecognizerRunner(
+                self.__cfg.filename())
+            self.__recognizer.start()
+        self.__recognizer.start_job(job['method'], *job['args'],
+                                    **job['kwargs'])
+        self.__recognizer_busy = True
+        return True
+
+    def __preempt_job(self):
+        # recognizer stops with commit at next step, job is requeued
+        job = self.__jobs.next()
+        if job is not None and not self.__job_preempted and \
+                job['priority'] > self.__job['priority']:
+            log.info(f'Job {self.__job["id"]} preempted by {job["id"]}')
+            self.__job_preempted = True
+            self.__recognizer.stop(True)
+
+    def __finish_job(self, status):
+        self.__recognizer_busy = False
+        job_id = self.__job['id']
+        if status['state'] == 'error':
+            # restart worker process for next job
+            self.__recognizer.join()
+            self.__recognizer = None
+            self.__jobs.finish(job_id, 'error', status.get('error'))
+        elif self.__job_stopped:
+            self.__jobs.finish(job_id, 'stopped')
+        elif self.__job_preempted:
+            self.__jobs.requeue(job_id, status.get('resume'))
+        else:
+            self.__jobs.finish(job_id, 'done')
+        log.info(f'Job {job_id} finished: {status["state"]}')
 
     def __generate_patterns(self):
-        self.__status = {'state': 'patterns_generation'}
-        self.__patterns.generate()
-        self.__load_patterns_persons()
-
-    def update_persons(self, name):
-        if name not in self.__names:
+        with self.__patterns_lock:
+            self.__set_status({'state': 'patterns_generation'})
             self.__patterns.generate()
             self.__load_patterns_persons()
 
+    def __update_persons(self, name):
+        with self.__patterns_lock:
+            if name not in self.__names:
+                self.__patterns.generate()
+                self.__load_patterns_persons()
+
     def __load_patterns_persons(self):
         self.__names = [
             p['name'] for p in self.__patterns.persons()
@@ -442,69 +887,249 @@ class FaceRecServer(http.server.HTTPServer):
         return self.__patterns
 
     def names(self):
-        return self.__names
+        with self.__patterns_lock:
+            return self.__names
 
     def name_image(self, name):
-        return self.__name_images[name]
+        with self.__patterns_lock:
+            return self.__name_images[name]
 
     def db(self):
-        return self.__db
+        # sqlite connection can be used only in thread which created it
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = recdb.RecDB(self.__db_file, readonly=True)
+            self.__local.db = db
+        return db
 
     def cdb(self):
         return self.__cdb
 
+    def face_overlay(self, data):
+        key = hashlib.md5(data).digest()
+        with self.__overlay_lock:
+            overlay = self.__overlay_cache.get(key, False)
+            if overlay is not False:
+                self.__overlay_cache.move_to_end(key)
+        if overlay is False:
+            overlay = tools.render_face_overlay(data)
+            with self.__overlay_lock:
+                self.__overlay_cache[key] = overlay
+                if len(self.__overlay_cache) > self.__overlay_cache_size:
+                    self.__overlay_cache.popitem(last=False)
+        if overlay is None:
+            return data
+        return overlay
+
+    def __read_face(self, fname):
+        if self.__cdb is not None:
+            return self.__cdb.get_from_cache(fname)
+        try:
+            with open(fname, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def __sprite_version(self):
+        # sprite is valid until faces are added, replaced or removed
+        if self.__cdb is None:
+            return None
+        return (self.__cdb.generation(), self.__cdb.last_cache_id())
+
+    def __sprite_etag(self, key, version, files):
+        # without cachedb changes are detected by faces list only
+        return '"sprite-{}"'.format(hashlib.md5(repr(
+            (key, version if version is not None else files)).encode(
+                'utf-8')).hexdigest())
+
+    def face_sprite_etag(self, key, list_files):
+        version = self.__sprite_version()
+        return self.__sprite_etag(
+            key, version, list_files() if version is None else None)
+
+    def face_sprite(self, key, list_files, overlay, size, columns):
+        version = self.__sprite_version()
+        if version is not None:
+            with self.__sprite_lock:
+                sprite = self.__sprite_cache.get(key)
+                if sprite is not None and sprite['version'] == version:
+                    self.__sprite_cache.move_to_end(key)
+                    return sprite
+
+        files = list_files()
+        datas = [self.__read_face(os.path.join(self.__face_cache_path, f))
+                 for f in files]
+        data, tiles = tools.make_face_sprite(datas, overlay, size, columns)
+        sprite = {
+            'version': version,
+            'data': data,
+            'etag': self.__sprite_etag(key, version, files),
+            'tiles': [[f] + list(t) if t is not None else [f]
+                      for f, t in zip(files, tiles)]}
+
+        if version is not None:
+            with self.__sprite_lock:
+                self.__sprite_cache[key] = sprite
+                if len(self.__sprite_cache) > self.__sprite_cache_size:
+                    self.__sprite_cache.popitem(last=False)
+        return sprite
+
+    def face_preview(self, descr, size):
+        size = max(PREVIEW_MIN_SIZE, min(size, self.__max_image_size))
+        src_filename = descr['src']
+        st = os.stat(src_filename)
+        key = hashlib.md5(repr((
+            src_filename, st.st_mtime_ns, st.st_size, descr.get('frame'),
+            descr.get('box'), size)).encode('utf-8')).hexdigest()
+        fname = self.__preview_cache.get(
+            key, lambda: tools.make_face_preview(
+                src_filename, descr, size, self.__max_image_size))
+        return fname, f'"preview-{key}"'
+
+    def __set_status(self, status):
+        with self.__status_cond:
+            if status != self.__status:
+                self.__status = status
+                self.__status_version += 1
+                self.__status_cond.notify_all()
+
+    def __status_loop(self):
+        while True:
+            try:
+                self.update_status()
+            except Exception as ex:
+                log.exception(ex)
+            # woken up by new job
+            self.__status_wakeup.wait(self.__status_interval)
+            self.__status_wakeup.clear()
+
+    def update_status(self):
+        with self.__lock:
+            status = None
+            if self.__recognizer_busy:
+                status = self.__recognizer.status()
+                if status['state'] not in ('done', 'error') and \
+                        not self.__recognizer.is_alive():
+                    status['state'] = 'error'
+                    status['error'] = 'Recognizer process terminated'
+                if status['state'] in ('done', 'error'):
+                    self.__finish_job(status)
+
+            # next job is started without reporting of finished one
+            job = None
+            if self.__recognizer_busy:
+                self.__preempt_job()
+            elif not self.__job_starting:
+                job = self.__next_job()
+
+        if job is not None:
+            # patterns generation is long, requests are not blocked
+            try:
+                self.__prepare_job(job)
+            except Exception as ex:
+                log.exception(ex)
+                with self.__lock:
+                    self.__job_starting = False
+                    self.__jobs.finish(job['id'], 'error', str(ex))
+                self.__set_status({'state': 'error', 'error': str(ex),
+                                   'job_id': job['id']})
+                return
+            with self.__lock:
+                if self.__run_job(job):
+                    status = self.__recognizer.status()
+                else:
+                    status = dict(tools.RECOGNIZER_STATUS_INIT)
+                    status.update({'state': 'done', 'stop': True})
+
+        if status is not None:
+            status['job_id'] = self.__job['id']
+            status['queued'] = self.__jobs.count_queued()
+            self.__set_status(status)
+
     def status(self):
-        if self.__recognizer:
-            self.__status = self.__recognizer.status()
-            if self.__status['state'] in ('done', 'error'):
-                self.__recognizer.join()
+        with self.__status_cond:
+            return self.__status
+
+    def wait_status(self, version, timeout):
+        with self.__status_cond:
+            self.__status_cond.wait_for(
+                lambda: self.__status_version != version, timeout)
+            return self.__status_version, self.__status
+
+    def status_stream_acquire(self):
+        return self.__status_streams.acquire(blocking=False)
+
+    def status_stream_release(self):
+        self.__status_streams.release()
+
+    def close_recognizer(self):
+        with self.__lock:
+            if self.__recognizer is not None:
+                self.__recognizer.shutdown()
                 self.__recognizer = None
 
-        return self.__status
+    def jobs(self):
+        return self.__jobs.list_jobs()
+
+    def cancel_job(self, job_id):
+        return self.__jobs.cancel(job_id)
 
     def stop(self, save):
-        if self.__recognizer:
-            self.__recognizer.stop(save)
+        with self.__lock:
+            if self.__job_starting:
+                self.__job_stopped = True
+            elif self.__recognizer_busy:
+                self.__job_stopped = True
+                self.__recognizer.stop(save)
 
     def clean_cache(self):
-        if self.__cdb is not None:
-            self.__cdb.clean_cache()
-        elif os.path.exists(self.__face_cache_path):
-            shutil.rmtree(self.__face_cache_path)
+        with self.__lock:
+            if self.__cdb is not None:
+                self.__cdb.clean_cache()
+            elif os.path.exists(self.__face_cache_path):
+                shutil.rmtree(self.__face_cache_path)
+
+    def add_to_pattern(self, name, files, bad):
+        filenames = [os.path.join(self.__face_cache_path, f) for f in files]
+        with self.__patterns_lock:
+            if self.__cdb is not None:
+                for fn in filenames:
+                    data = self.__cdb.get_from_cache(fn)
+                    if data is None:
+                        raise Exception(f'No data for file {fn}')
+                    self.__patterns.add_file_data(name, fn, data, bad)
+                    self.__cdb.remove_from_cache(fn)
+                self.__cdb.commit()
+            else:
+                self.__patterns.add_files(name, filenames, True, True, bad)
+            self.__update_persons(name)
+        with self.__sprite_lock:
+            self.__sprite_cache.clear()
 
     def recognize_folder(self, path, reencode, skip_face_gen):
-        self.__generate_patterns()
-        if not skip_face_gen:
-            self.clean_cache()
-        self.__start_recognizer('recognize_folder',
-                                path, self.__face_cache_path,
-                                reencode,
-                                skip_face_gen)
+        return self.__start_recognizer('recognize_folder',
+                                       path, self.__face_cache_path,
+                                       reencode,
+                                       skip_face_gen)
 
     def match(self, fltr, save_faces, skip_face_gen):
-        self.__generate_patterns()
-        if not skip_face_gen:
-            self.clean_cache()
-        self.__start_recognizer('match',
-                                fltr, self.__face_cache_path,
-                                save_faces,
-                                skip_face_gen)
+        return self.__start_recognizer('match',
+                                       fltr, self.__face_cache_path,
+                                       save_faces,
+                                       skip_face_gen)
 
     def clusterize(self, fltr):
-        self.clean_cache()
-        self.__start_recognizer('clusterize',
-                                fltr, self.__face_cache_path)
+        return self.__start_recognizer('clusterize',
+                                       fltr, self.__face_cache_path)
 
     def save_faces(self, fltr):
-        self.clean_cache()
-        self.__start_recognizer('save_faces',
-                                fltr, self.__face_cache_path)
+        return self.__start_recognizer('save_faces',
+                                       fltr, self.__face_cache_path)
 
     def get_faces_by_face(self, filename):
-        self.clean_cache()
-        self.__start_recognizer('get_faces_by_face',
-                                filename, self.__face_cache_path,
-                                True)
+        return self.__start_recognizer('get_faces_by_face',
+                                       filename, self.__face_cache_path,
+                                       True)
 
 
 def args_parse():
@@ -532,7 +1157,7 @@ def main():
         server.serve_forever()
     except KeyboardInterrupt:
         server.stop(False)
-        server.status()
+        server.close_recognizer()
         server.server_close()
         log.info("Face rec server down.")
 
@@ -1,13 +1,13 @@
 import io
 import os
-import cv2
 import sys
 import glob
 import math
-import piexif
+import numpy
+import struct
 import pickle
+import threading
 import collections
-from PIL import Image, ImageDraw
 
 sys.path.insert(0, os.path.abspath('..'))
 
@@ -16,12 +16,24 @@ from face_rec_tools import log  # noqa
 IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
 VIDEO_EXTS = ('.mp4', '.mpg', '.mpeg', '.mov', '.avi', '.mts')
 
+# seek video instead of frames skipping if distance is bigger
+VIDEO_SEEK_MIN_FRAMES = 50
+
+# face description binary format, stored in EXIF MakerNote
+FACE_DESCR_MAGIC = b'FRD'
+FACE_DESCR_VERSION = 1
+FACE_DESCR_FIELDS = ('encoding', 'box', 'frame', 'face_id', 'src',
+                     'landmarks')
+# landmarks lines are not drawn in image and rendered on demand
+FACE_DESCR_OVERLAY = 1 << len(FACE_DESCR_FIELDS)
+
 RECOGNIZER_STATUS_INIT = {
     'state': '',
     'count': 0,
     'current': 0,
     'faces_count': 0,
     'faces_per_second': 0,
+    'faces_refined': 0,
     'args': {},
     'starttime': 0,
     'stop': False
@@ -100,11 +112,15 @@ def cuda_release():
 
 
 def read_image(image_file, max_size):
+    import cv2
+
     image = cv2.imread(image_file)
     return prepare_image(image, max_size)
 
 
 def read_video(video_file, max_size, max_video_frames, video_frames_step):
+    import cv2
+
     if video_frames_step <= 0:
         log.error('video_frames_step must be > 0')
         return {}
@@ -114,17 +130,43 @@ def read_video(video_file, max_size, max_video_frames, video_frames_step):
     video = cv2.VideoCapture(video_file)
     frames = {}
     for fnum in range(max_video_frames):
+        if fnum % video_frames_step:
+            # skip frame without decoding
+            if not video.grab():
+                break
+            continue
         ret, frame = video.read()
         if not ret:
             break
-        if fnum % video_frames_step:
-            continue
         frame = prepare_image(frame, max_size)
         frames[fnum] = frame
     return frames
 
 
+def read_video_frames(video_file, max_size, frame_nums):
+    import cv2
+
+    video = cv2.VideoCapture(video_file)
+    frames = {}
+    pos = 0
+    for fnum in sorted(frame_nums):
+        if fnum - pos > VIDEO_SEEK_MIN_FRAMES:
+            video.set(cv2.CAP_PROP_POS_FRAMES, fnum)
+            pos = fnum
+        while pos < fnum and video.grab():
+            pos += 1
+        ret, frame = video.read()
+        if not ret:
+            log.warning(f'frame {fnum} reading failed: {video_file}')
+            break
+        pos += 1
+        frames[fnum] = prepare_image(frame, max_size)
+    return frames
+
+
 def prepare_image(image, max_size):
+    import cv2
+
     height, width, col = image.shape
 
     if height > width:
@@ -140,11 +182,99 @@ def prepare_image(image, max_size):
     return image
 
 
+def pack_face_description(descr):
+    flags = 0
+    for i, field in enumerate(FACE_DESCR_FIELDS):
+        if descr.get(field) is not None:
+            flags |= 1 << i
+    if descr.get('overlay', False):
+        flags |= FACE_DESCR_OVERLAY
+    out = [struct.pack('<3sBB', FACE_DESCR_MAGIC, FACE_DESCR_VERSION, flags)]
+
+    if descr.get('encoding') is not None:
+        encoding = numpy.asarray(descr['encoding'], dtype='<f4')
+        out.append(struct.pack('<H', len(encoding)))
+        out.append(encoding.tobytes())
+    if descr.get('box') is not None:
+        out.append(struct.pack('<4i', *descr['box']))
+    if descr.get('frame') is not None:
+        out.append(struct.pack('<i', descr['frame']))
+    if descr.get('face_id') is not None:
+        out.append(struct.pack('<q', descr['face_id']))
+    if descr.get('src') is not None:
+        src = descr['src'].encode('utf-8')
+        out.append(struct.pack('<I', len(src)))
+        out.append(src)
+    if descr.get('landmarks') is not None:
+        out.append(struct.pack('<B', len(descr['landmarks'])))
+        for name, pts in descr['landmarks'].items():
+            name = name.encode('utf-8')
+            out.append(struct.pack('<B', len(name)))
+            out.append(name)
+            out.append(struct.pack('<H', len(pts)))
+            out.append(numpy.asarray(pts, dtype='<i2').tobytes())
+    return b''.join(out)
+
+
+def unpack_face_description(data):
+    magic, version, flags = struct.unpack_from('<3sBB', data)
+    if magic != FACE_DESCR_MAGIC or version != FACE_DESCR_VERSION:
+        raise ValueError(f'Unknown face description: {magic} {version}')
+    pos = struct.calcsize('<3sBB')
+
+    def unpack(fmt):
+        nonlocal pos
+        res = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        return res
+
+    def unpack_array(dtype, count):
+        nonlocal pos
+        res = numpy.frombuffer(data, dtype=dtype, count=count, offset=pos)
+        pos += res.nbytes
+        return res
+
+    descr = {}
+    if flags & 1:
+        count, = unpack('<H')
+        descr['encoding'] = unpack_array('<f4', count).astype(numpy.float64)
+    if flags & 2:
+        descr['box'] = unpack('<4i')
+    if flags & 4:
+        descr['frame'], = unpack('<i')
+    if flags & 8:
+        descr['face_id'], = unpack('<q')
+    if flags & 16:
+        length, = unpack('<I')
+        descr['src'] = data[pos:pos + length].decode('utf-8')
+        pos += length
+    if flags & 32:
+        descr['landmarks'] = {}
+        count, = unpack('<B')
+        for i in range(count):
+            length, = unpack('<B')
+            name = data[pos:pos + length].decode('utf-8')
+            pos += length
+            pts_count, = unpack('<H')
+            pts = unpack_array('<i2', pts_count * 2).reshape(-1, 2)
+            descr['landmarks'][name] = [tuple(pt) for pt in pts.tolist()]
+    descr['overlay'] = bool(flags & FACE_DESCR_OVERLAY)
+    return descr
+
+
 def load_face_description(filename):
+    import piexif
+    from PIL import Image
+
     try:
         exif = piexif.load(filename)
-        encd = exif["0th"][piexif.ImageIFD.ImageDescription]
-        descr = pickle.loads(encd)
+        encd = exif['Exif'].get(piexif.ExifIFD.MakerNote)
+        if encd is not None:
+            descr = unpack_face_description(encd)
+        else:
+            # old files: protocol 0 pickle in ImageDescription
+            encd = exif["0th"][piexif.ImageIFD.ImageDescription]
+            descr = pickle.loads(encd)
         thumbnail = exif.pop('thumbnail')
         if thumbnail is not None:
             thumbnail = Image.open(io.BytesIO(thumbnail))
@@ -154,18 +284,79 @@ def load_face_description(filename):
 
 
 def load_face_thumbnail(filename):
+    import piexif
+
     exif = piexif.load(filename)
     return exif.pop('thumbnail')
 
 
+def render_face_overlay(data):
+    from PIL import Image
+
+    descr = load_face_description(data)[0]
+    if descr is None or not descr.get('overlay', False) or \
+            not descr.get('landmarks'):
+        return None
+
+    image = Image.open(io.BytesIO(data))
+    exif = image.info.get('exif', b'')
+    __set_landmarks_lines(image, descr['landmarks'])
+    out_stream = io.BytesIO()
+    image.save(out_stream, exif=exif, format="JPEG", quality=90)
+    return out_stream.getvalue()
+
+
+def load_face_image(data, overlay):
+    from PIL import Image
+
+    descr, thumbnail = load_face_description(data)
+    if not overlay:
+        # old face files keep image without landmarks in thumbnail
+        if thumbnail is not None:
+            return thumbnail
+        return Image.open(io.BytesIO(data))
+
+    image = Image.open(io.BytesIO(data))
+    if descr is not None and descr.get('overlay', False) and \
+            descr.get('landmarks'):
+        image.load()
+        __set_landmarks_lines(image, descr['landmarks'])
+    return image
+
+
+def make_face_sprite(datas, overlay, size, columns):
+    from PIL import Image
+
+    rows = (len(datas) + columns - 1) // columns
+    sprite = Image.new('RGB', (max(min(len(datas), columns), 1) * size,
+                               max(rows, 1) * size))
+    tiles = []
+    for i, data in enumerate(datas):
+        if data is None:
+            tiles.append(None)
+            continue
+        image = load_face_image(data, overlay)
+        image.thumbnail((size, size))
+        x = (i % columns) * size
+        y = (i // columns) * size
+        sprite.paste(image, (x, y))
+        tiles.append((x, y) + image.size)
+
+    out_stream = io.BytesIO()
+    sprite.save(out_stream, format="JPEG", quality=90)
+    return out_stream.getvalue(), tiles
+
+
 def save_with_description(image, descr, thumbnail, filename):
+    import piexif
+
     thumbnail_data = None
     if thumbnail is not None:
         o = io.BytesIO()
         thumbnail.save(o, format="JPEG", quality=90)
         thumbnail_data = o.getvalue()
-    encd = pickle.dumps(descr, protocol=0)
-    exif = piexif.dump({"0th": {piexif.ImageIFD.ImageDescription: encd},
+    encd = pack_face_description(descr)
+    exif = piexif.dump({"Exif": {piexif.ExifIFD.MakerNote: encd},
                         "thumbnail": thumbnail_data, "1st": {}})
     image.save(filename, exif=exif, format="JPEG", quality=90)
 
@@ -183,6 +374,8 @@ def __set_landmarks(image, face_landmarks):
 
 
 def __set_landmarks_lines(image, face_landmarks):
+    from PIL import ImageDraw
+
     if len(face_landmarks) == 0:
         return
     draw = ImageDraw.Draw(image)
@@ -194,8 +387,11 @@ def __set_landmarks_lines(image, face_landmarks):
 
 
 def enable_landmarks(filename, enable):
+    from PIL import Image
+
     descr, thumbnail = load_face_description(filename)
-    enabled = thumbnail is not None
+    enabled = thumbnail is not None or \
+        descr is not None and descr.get('overlay', False)
 
     if enable == enabled:
         log.debug(f'enable_landmarks skip: {filename}')
@@ -206,10 +402,11 @@ def enable_landmarks(filename, enable):
         return
 
     image = Image.open(filename)
+    descr['overlay'] = False
     if enable:
         thumbnail = image.copy()
         __set_landmarks_lines(image, descr['landmarks'])
-    else:
+    elif thumbnail is not None:
         image = thumbnail
         thumbnail = None
     save_with_description(image, descr, thumbnail, filename)
@@ -271,8 +468,10 @@ def test_landmarks(l):
     return True
 
 
-def save_face(out_filename, image, enc, out_size, src_filename):
-    top, right, bottom, left = enc['box']
+def crop_face(image, box):
+    import cv2
+
+    top, right, bottom, left = box
     d = (bottom - top) // 2
     top -= d
     left -= d
@@ -286,8 +485,15 @@ def save_face(out_filename, image, enc, out_size, src_filename):
                                        max(0, -top), max(0, bottom - height),
                                        max(0, -left), max(0, right - width),
                                        cv2.BORDER_CONSTANT, None, 0)
+    return out_image, (top, right, bottom, left)
+
+
+def save_face_image(out_filename, face_image, face_box, enc, out_size,
+                    src_filename):
+    from PIL import Image
 
-    im = Image.fromarray(out_image)
+    top, right, bottom, left = face_box
+    im = Image.fromarray(face_image)
     im.thumbnail((out_size, out_size))
 
     face_landmarks = {}
@@ -302,16 +508,22 @@ def save_face(out_filename, image, enc, out_size, src_filename):
                     int((pt[1] - top) * vk)))
             face_landmarks[landmark] = face_pts
 
-    thumbnail = im.copy()
-    __set_landmarks_lines(im, face_landmarks)
+    # landmarks lines are drawn by server on demand
     descr = {'encoding': enc['encoding'],
              'landmarks': face_landmarks,
              'box': enc['box'],
              'frame': enc['frame'],
              'face_id': enc['face_id'],
-             'src': src_filename}
+             'src': src_filename,
+             'overlay': True}
 
-    save_with_description(im, descr, thumbnail, out_filename)
+    save_with_description(im, descr, None, out_filename)
+
+
+def save_face(out_filename, image, enc, out_size, src_filename):
+    face_image, face_box = crop_face(image, enc['box'])
+    save_face_image(out_filename, face_image, face_box, enc, out_size,
+                    src_filename)
 
 
 def filter_images(files_faces):
@@ -371,6 +583,9 @@ class LazyImage(object):
         self.__max_size = max_size
         self.__image = None
 
+    def preload(self, dummy_frame_nums):
+        pass
+
     def get(self, dummy_frame_num=0):
         if self.__image is None:
             log.debug(f'LazyImage load: {self.__image_file}')
@@ -380,6 +595,11 @@ class LazyImage(object):
     def filename(self):
         return self.__image_file
 
+    def nbytes(self):
+        if self.__image is None:
+            return 0
+        return self.__image.nbytes
+
 
 class LazyVideo(object):
     def __init__(self,
@@ -392,6 +612,7 @@ class LazyVideo(object):
         self.__max_video_frames = max_video_frames
         self.__video_frames_step = video_frames_step
         self.__frames = None
+        self.__cached_frames = {}
 
     def frames(self):
         if self.__frames is None:
@@ -400,14 +621,36 @@ class LazyVideo(object):
                                        self.__max_size,
                                        self.__max_video_frames,
                                        self.__video_frames_step)
+            self.__cached_frames = {}
         return self.__frames
 
+    def preload(self, frame_nums):
+        if self.__frames is not None:
+            return
+        frame_nums = set(frame_nums) - set(self.__cached_frames)
+        if len(frame_nums) == 0:
+            return
+        log.debug(f'LazyVideo load {len(frame_nums)} frames: '
+                  f'{self.__video_file}')
+        self.__cached_frames.update(read_video_frames(self.__video_file,
+                                                      self.__max_size,
+                                                      frame_nums))
+
     def get(self, frame_num):
-        return self.frames()[frame_num]
+        if self.__frames is not None:
+            return self.__frames[frame_num]
+        self.preload((frame_num,))
+        return self.__cached_frames[frame_num]
 
     def filename(self):
         return self.__video_file
 
+    def nbytes(self):
+        frames = self.__cached_frames
+        if self.__frames is not None:
+            frames = self.__frames
+        return sum(frame.nbytes for frame in frames.values())
+
 
 def load_media(media_file, max_size, max_video_frames, video_frames_step):
     ext = get_low_ext(media_file)
@@ -420,6 +663,130 @@ def load_media(media_file, max_size, max_video_frames, video_frames_step):
         raise Exception(f'Unknown ext: {ext}')
 
 
+class MediaCache(object):
+    def __init__(self,
+                 max_size,
+                 max_video_frames,
+                 video_frames_step,
+                 max_memory):
+        self.__max_size = max_size
+        self.__max_video_frames = max_video_frames
+        self.__video_frames_step = video_frames_step
+        self.__max_memory = max_memory * 1024 * 1024
+        self.__media = collections.OrderedDict()
+
+    def __evict(self):
+        # decoding is lazy, so the last media is accounted on next call
+        total = sum(m.nbytes() for m in self.__media.values())
+        while total > self.__max_memory and len(self.__media) > 1:
+            filename, media = self.__media.popitem(last=False)
+            total -= media.nbytes()
+            log.debug(f'MediaCache evict: {filename}')
+
+    def get(self, media_file):
+        media = self.__media.pop(media_file, None)
+        if media is None:
+            media = load_media(media_file,
+                               self.__max_size,
+                               self.__max_video_frames,
+                               self.__video_frames_step)
+        self.__evict()
+        self.__media[media_file] = media
+        return media
+
+    def clear(self):
+        self.__media.clear()
+
+
+def __read_image_preview(filename, size, max_size):
+    from PIL import Image
+    from PIL import ImageOps
+
+    image = Image.open(filename)
+    width, height = image.size
+    if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        width, height = height, width
+    # faces boxes are in coordinates of image reduced to max_size
+    scale = min(1, max_size / max(width, height))
+    detect_width = int(width * scale)
+
+    # reduced resolution JPEG decoding
+    image.draft('RGB', (size, size))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail((size, size))
+    return image, image.size[0] / detect_width
+
+
+def __read_video_preview(filename, frame, size, max_size):
+    from PIL import Image
+
+    frames = read_video_frames(filename, max_size, (frame,))
+    if frame not in frames:
+        raise Exception(f'Frame {frame} reading failed: {filename}')
+    image = Image.fromarray(frames[frame])
+    detect_width = image.size[0]
+    image.thumbnail((size, size))
+    return image, image.size[0] / detect_width
+
+
+def make_face_preview(filename, descr, size, max_size):
+    from PIL import ImageDraw
+
+    if get_low_ext(filename) in VIDEO_EXTS:
+        image, scale = __read_video_preview(filename, descr.get('frame', 0),
+                                            size, max_size)
+    else:
+        image, scale = __read_image_preview(filename, size, max_size)
+
+    if descr.get('box') is not None:
+        top, right, bottom, left = (int(v * scale) for v in descr['box'])
+        ImageDraw.Draw(image).rectangle((left, top, right, bottom),
+                                        outline=(255, 255, 255), width=2)
+
+    out_stream = io.BytesIO()
+    image.save(out_stream, format="JPEG", quality=85)
+    return out_stream.getvalue()
+
+
+class PreviewCache(object):
+    def __init__(self, path, max_size):
+        self.__path = path
+        self.__max_size = max_size * 1024 * 1024
+        self.__lock = threading.Lock()
+        os.makedirs(self.__path, exist_ok=True)
+        self.__size = sum(e.stat().st_size for e in os.scandir(self.__path))
+
+    def __evict(self):
+        # file mtime is used as last access time
+        entries = sorted(os.scandir(self.__path),
+                         key=lambda e: e.stat().st_mtime)
+        for e in entries:
+            if self.__size <= self.__max_size:
+                break
+            self.__size -= e.stat().st_size
+            os.remove(e.path)
+            log.debug(f'PreviewCache evict: {e.path}')
+
+    def get(self, key, make_preview):
+        filename = os.path.join(self.__path, key + '.jpg')
+        try:
+            os.utime(filename)
+            return filename
+        except FileNotFoundError:
+            pass
+
+        data = make_preview()
+        tmp_filename = f'{filename}.{threading.get_ident()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+        with self.__lock:
+            self.__size += len(data)
+            if self.__size > self.__max_size:
+                self.__evict()
+        return filename
+
+
 def cursor_iterator(cursor, count=1000):
     while True:
         res = cursor.fetchmany(count)